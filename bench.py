@@ -0,0 +1,428 @@
+# -*- coding:utf-8 -*-
+import io
+import os
+import sys
+import json
+import math
+import random
+import argparse
+import platform
+import tempfile
+
+from time import perf_counter, strftime
+from itertools import product
+from contextlib import redirect_stdout
+from typing import List, Dict, Union, Optional, Tuple, Callable
+
+import patch
+
+# options of generate_policies shaping the rule sets, with their defaults
+SHAPE: Dict[str, Union[int, float]] = {'any_ratio': 0.05, 'range_ratio': 0.3, 'group_ratio': 0.2, 'accept_ratio': 0.6,
+                                       'udp_ratio': 0.25, 'inactive_ratio': 0.02, 'subnets': 64}
+
+
+def random_address(rng: random.Random, subnets: int) -> int:
+    subnet: int = rng.randrange(subnets)
+    return (10 << 24) | (subnet << 8) | rng.randrange(256)
+
+
+def format_ip(address: int) -> str:
+    return patch.int2ip(address)
+
+
+def generate_addresses(rng: random.Random, count: int, subnets: int,
+                       range_ratio: float, group_ratio: float) -> List[str]:
+    """
+    Address objects shared by the rules, as firewall exports reuse a few of them across many rules:
+    single addresses, ranges inside a /24, and comma-separated groups of both.
+    """
+
+    def _element_() -> str:
+        start: int = random_address(rng, subnets)
+        if rng.random() < range_ratio:
+            end: int = min(start | 255, start + rng.randrange(1, 128))
+            return f'{format_ip(start)}-{format_ip(end)}'
+        return format_ip(start)
+
+    addresses: List[str] = list()
+    for _ in range(count):
+        if rng.random() < group_ratio:
+            addresses.append(','.join(_element_() for _ in range(rng.randint(2, 4))))
+        else:
+            addresses.append(_element_())
+    return addresses
+
+
+def generate_ports(rng: random.Random, count: int, range_ratio: float, group_ratio: float,
+                   udp_ratio: float) -> List[str]:
+    services: List[int] = [20, 21, 22, 23, 25, 53, 80, 110, 123, 143, 389, 443, 445, 636, 993, 1433, 1521,
+                           3306, 3389, 5432, 6379, 8080, 8443, 9200]
+
+    def _element_() -> str:
+        protocol: str = 'udp' if rng.random() < udp_ratio else 'tcp'
+        if rng.random() < range_ratio:
+            start: int = rng.randrange(1024, 60000)
+            return f'{protocol}_{start}-{start + rng.randrange(1, 4096)}'
+        return f'{protocol}_{rng.choice(services)}'
+
+    ports: List[str] = list()
+    for _ in range(count):
+        if rng.random() < group_ratio:
+            ports.append(','.join(_element_() for _ in range(rng.randint(2, 3))))
+        else:
+            ports.append(_element_())
+    return ports
+
+
+def generate_policies(size: int, seed: int, any_ratio: float = 0.05, range_ratio: float = 0.3,
+                      group_ratio: float = 0.2, accept_ratio: float = 0.6, udp_ratio: float = 0.25,
+                      inactive_ratio: float = 0.02, subnets: int = 64) -> List[List[str]]:
+    """
+    Synthetic rules in the default column layout of patch.py (protocol combined with dst_port):
+    id, -, inactive, -, src_ip, src_port, -, dst_ip, -, dst_port, action.
+    """
+    rng: random.Random = random.Random(seed)
+
+    addresses: List[str] = generate_addresses(rng, max(16, size // 20), subnets, range_ratio, group_ratio)
+    ports: List[str] = generate_ports(rng, max(8, size // 50), range_ratio, group_ratio, udp_ratio)
+
+    policies: List[List[str]] = list()
+    for pid in range(1, size + 1):
+        src_ip: str = 'ANY' if rng.random() < any_ratio else rng.choice(addresses)
+        dst_ip: str = 'ANY' if rng.random() < any_ratio else rng.choice(addresses)
+        dst_port: str = 'ANY' if rng.random() < any_ratio else rng.choice(ports)
+        inactive: str = 'disabled' if rng.random() < inactive_ratio else ''
+        action: str = 'accept' if rng.random() < accept_ratio else 'deny'
+        policies.append([str(pid), '', inactive, '', src_ip, 'ANY', '', dst_ip, '', dst_port, action])
+
+    return policies
+
+
+def write_policies(path: str, policies: List[List[str]]):
+    import csv
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(policies)
+
+
+def shape_of(args) -> Dict[str, Union[int, float]]:
+    return {option: getattr(args, option) for option in SHAPE}
+
+
+def run_benchmark(size: int, seed: int, args) -> Dict[str, Union[int, float]]:
+    with tempfile.TemporaryDirectory() as workdir:
+        fpath: str = os.path.join(workdir, 'rules.csv')
+        write_policies(fpath, generate_policies(size, seed, **shape_of(args)))
+
+        config = patch.build_parser().parse_args([
+            '--test=0', '--private_cloud=0', f'--fpath={fpath}', f'--cdir={os.path.join(workdir, "conflicts")}',
+            f'--oa={os.path.join(workdir, "overauthorization.txt")}', f'--disable={os.path.join(workdir, "disable.txt")}',
+            f'--report={os.path.join(workdir, "report.txt")}', f'--engine={args.engine}', f'--workers={args.workers}',
+            f'--prune={args.prune}', f'--stream={args.stream}'])
+        os.makedirs(config.cdir)
+
+        timings: Dict[str, float] = dict()
+        with redirect_stdout(io.StringIO()):
+            start: float = perf_counter()
+            table, _, _ = patch.load_table(config)
+            timings['parse'] = perf_counter() - start
+
+            start = perf_counter()
+            pairs: int = patch.detect_all_conflicts(table, config)
+            timings['detect'] = perf_counter() - start
+
+            start = perf_counter()
+            patch.sum(config)
+            timings['sum'] = perf_counter() - start
+
+        with open(os.path.join(workdir, 'report.json'), 'r') as f:
+            conflicts: int = json.load(f)['total']
+
+    return dict(size=size, seed=seed, **shape_of(args), rules=len(table), pairs=pairs, conflicts=conflicts, **timings)
+
+
+def random_rule(rng: random.Random, pid: int) -> List[str]:
+    """
+    A rule in the default column layout with groups in every field, source ports and a mix of protocols,
+    the bounds drawn from few values so that equal, nested and adjacent ranges are frequent.
+    """
+    ips: List[int] = [0, 10 << 24, (10 << 24) + 255, (10 << 24) + 256, (10 << 24) + 1024, 4294967295]
+    ports: List[int] = [0, 22, 80, 443, 1024, 8080, 65535]
+
+    def _group_(bounds: List[int], element: Callable[[int, int], str]) -> str:
+        if rng.random() < 0.1:
+            return 'ANY'
+        return ','.join(element(*(sorted(rng.sample(bounds, 2)) if rng.random() < 0.7 else [rng.choice(bounds)] * 2))
+                        for _ in range(rng.choice([1, 1, 2, 3])))
+
+    def _ip_(start: int, end: int) -> str:
+        return format_ip(start) if start == end else f'{format_ip(start)}-{format_ip(end)}'
+
+    def _port_(start: int, end: int) -> str:
+        protocol: str = rng.choice(['tcp', 'tcp', 'udp', 'icmp', 'any'])
+        return f'{protocol}_{start}' if start == end else f'{protocol}_{start}-{end}'
+
+    return [str(pid), '', '', '', _group_(ips, _ip_), _group_(ports, _port_), '',
+            _group_(ips, _ip_), '', _group_(ports, _port_), rng.choice(['accept', 'deny'])]
+
+
+def reference_conflicts(table: patch.RuleTable, i: int, j: int) -> List[Dict[str, Union[int, str]]]:
+    """
+    The conflicts of rules i and j by the reference _detect_conflict_between_pure_, one Policy per group
+    and every combination of the groups in the order of detect_conflicts_between_policies.
+    """
+    columns: List[patch.RangeColumn] = [table.src_ip, table.src_port, table.dst_ip, table.dst_port]
+
+    def _policy_(rule: int, entries: Tuple[int, ...]) -> patch.Policy:
+        src_ip, src_port, dst_ip, dst_port = ({'start': column.starts[entry], 'end': column.ends[entry]}
+                                              for column, entry in zip(columns, entries))
+        return patch.Policy(table.pids[rule], table.protocol_names[table.protocols[entries[3]]],
+                            src_ip, src_port, dst_ip, dst_port, False, table.action_name(rule))
+
+    conflicts: List[Dict[str, Union[int, str]]] = list()
+    for pairs in product(*(product(column.span(i), column.span(j)) for column in columns)):
+        pack: Dict[str, Union[int, str]] = patch._detect_conflict_between_pure_(
+            _policy_(i, tuple(pair[0] for pair in pairs)), _policy_(j, tuple(pair[1] for pair in pairs)))
+        if pack['conflict']:
+            conflicts.append(patch.socket_pack(table, i, j, tuple(entry for pair in pairs for entry in pair), pack))
+    return conflicts
+
+
+def compare_engines(pairs: int, seed: int, size: int = 64) -> Tuple[int, Dict[str, float]]:
+    """
+    Differential check of the detection engines (python, python with the records of --memory, numpy if installed,
+    each of them with and without pruning) against the reference _detect_conflict_between_pure_ on random tables
+    of `size` rules, until `pairs` pairs of rules are compared: the number of pairs they disagree on and the
+    seconds of every engine.
+    """
+    rng: random.Random = random.Random(seed)
+    engines: List[str] = ['python', 'records'] + (['numpy'] if patch.np is not None else [])
+    seconds: Dict[str, float] = dict.fromkeys(['reference'] + [f'{engine}, prune {prune}' for engine in engines
+                                                               for prune in [0, 1]], 0.0)
+    mismatches: int = 0
+    compared: int = 0
+
+    while compared < pairs:
+        config = patch.build_parser().parse_args(['--test=0', '--private_cloud=0'])
+        table: patch.RuleTable = patch.compile_rules((random_rule(rng, pid) for pid in range(size)), config)
+
+        start: float = perf_counter()
+        expected: List[Dict[Tuple[str, str], List[Dict]]] = [
+            {(table.pids[i], table.pids[j]): reference_conflicts(table, i, j) for j in range(i + 1, size)}
+            for i in range(size)]
+        seconds['reference'] += perf_counter() - start
+
+        for engine, prune in product(engines, [0, 1]):
+            config.engine, config.prune = 'python' if engine == 'records' else engine, prune
+            config.memory = 1 if engine == 'records' else 0
+            start = perf_counter()
+            detector: patch.Detector = patch.Detector(table, config)
+            found: List[List] = [detector.collect(i) for i in range(size)]
+            seconds[f'{engine}, prune {prune}'] += perf_counter() - start
+
+            for i, conflicts in enumerate(found):
+                if engine == 'records':
+                    conflicts = [patch.render_record(table, record) for record in conflicts]
+                of_pairs: Dict[Tuple[str, str], List[Dict]] = {pair: list() for pair in expected[i]}
+                for conflict in conflicts:
+                    of_pairs.setdefault((conflict['pre'], conflict['sub']), list()).append(conflict)
+                for pair, conflicts_of_pair in of_pairs.items():
+                    if conflicts_of_pair != expected[i].get(pair, list()):
+                        mismatches += 1
+                        if mismatches <= 5:
+                            print(f'{engine}, prune {prune}: mismatch on {pair}: '
+                                  f'{conflicts_of_pair} != {expected[i].get(pair, list())}')
+
+        compared += size * (size - 1) // 2
+    return mismatches, seconds
+
+
+# rules telling packets apart by src_port only, and a rule of protocol tcp between rules of protocol any
+COMPACTION_CASES: List[List[List[str]]] = [
+    [['1', '', '', '', '10.0.0.1', 'tcp_80', '', '10.0.0.2', '', 'tcp_22', 'deny'],
+     ['2', '', '', '', '10.0.0.1', 'tcp_443', '', '10.0.0.2', '', 'tcp_22', 'accept'],
+     ['3', '', '', '', '10.0.0.0-10.0.0.127', 'ANY', '', '10.0.0.0-10.0.0.127', '', 'tcp_0-1000', 'deny']],
+    [['1', '', '', '', '10.0.0.1', 'ANY', '', '10.0.0.2', '', 'ANY', 'accept'],
+     ['2', '', '', '', '10.0.0.0-10.0.0.255', 'ANY', '', '10.0.0.2', '', 'tcp_5432', 'deny'],
+     ['3', '', '', '', '10.0.0.0-10.0.0.255', 'ANY', '', '10.0.0.0-10.0.0.255', '', 'ANY', 'accept']]
+]
+
+
+def compare_compaction(tables: int, seed: int, size: int = 40, generated: int = 1500,
+                       packets: int = 5000) -> Tuple[int, int]:
+    """
+    Differential check of compact_rules against the first-match classification of replay.Classifier: random packets
+    on the bounds of the rules are classified by the rules before and after the compaction, on COMPACTION_CASES
+    then alternately on random tables of `size` rules (random_rule) and on generated rule sets of the benchmark.
+    Return the number of tables whose packets get another action although the compaction was reported first-match
+    equivalent, and the number of tables on which it was not proven.
+    """
+    import csv
+    from replay import Classifier
+
+    rng: random.Random = random.Random(seed)
+    mismatches: int = 0
+    unproven: int = 0
+
+    def _bounds_(column: patch.RangeColumn, top: int) -> List[int]:
+        return sorted({bound for start, end in zip(column.starts, column.ends)
+                       for bound in (start - 1, start, end, end + 1) if 0 <= bound <= top})
+
+    def _action_(classifier: Classifier, packet: Tuple[int, int, int, int, str]) -> Optional[bool]:
+        src_ip, src_port, dst_ip, dst_port, protocol = packet
+        code: int = classifier.protocol_code(protocol)
+        rule: int = classifier.first_match((classifier.src_ip.locate(src_ip), classifier.src_port.locate(src_port),
+                                            classifier.dst_ip.locate(dst_ip), code,
+                                            classifier.dst_port[code].locate(dst_port)))
+        return bool(classifier.table.actions[rule]) if rule >= 0 else None
+
+    with tempfile.TemporaryDirectory() as workdir:
+        config = patch.build_parser().parse_args([
+            '--test=0', '--private_cloud=0', f'--fpath={os.path.join(workdir, "rules.csv")}',
+            f'--compact={os.path.join(workdir, "compact.csv")}'])
+
+        for number in range(tables):
+            if number < len(COMPACTION_CASES):
+                policies: List[List[str]] = COMPACTION_CASES[number]
+            elif number % 2:
+                policies = [random_rule(rng, pid) for pid in range(1, size + 1)]
+            else:
+                policies = generate_policies(generated, rng.randrange(1 << 30))
+            write_policies(config.fpath, policies)
+
+            with redirect_stdout(io.StringIO()):
+                report: Dict = patch.compact_rules(config)
+            with open(config.compact, 'r', newline='') as f:
+                compacted: List[List[str]] = list(csv.reader(f))
+
+            before: patch.RuleTable = patch.compile_rules(
+                (policy for policy in policies if not policy[config.inactive]), config)
+            classifiers: List[Classifier] = [Classifier(before), Classifier(patch.compile_rules(compacted, config))]
+
+            values: List[List[int]] = [_bounds_(before.src_ip, 4294967295), _bounds_(before.src_port, 65535),
+                                       _bounds_(before.dst_ip, 4294967295), _bounds_(before.dst_port, 65535)]
+            protocols: List[str] = sorted({name.lower() for name in before.protocol_names} - {'any'}) + ['gre']
+            # every packet on the bounds if they are few enough, random ones otherwise
+            count: int = len(protocols) * math.prod(len(bounds) for bounds in values)
+            for packet in product(*values, protocols) if count <= packets else \
+                    (tuple(rng.choice(bounds) for bounds in values + [protocols]) for _ in range(packets)):
+                actions: List[Optional[bool]] = [_action_(classifier, packet) for classifier in classifiers]
+                if actions[0] != actions[1]:
+                    if report['equivalent']:
+                        mismatches += 1
+                        print(f"table {number}: {report['before']} -> {report['after']} rules reported equivalent, "
+                              f"but packet {packet} gets {actions[0]} -> {actions[1]}")
+                    break
+            unproven += not report['equivalent']
+
+    return mismatches, unproven
+
+
+def compare(results: List[Dict], baseline: Dict, tolerance: float, slack: float) -> List[str]:
+    """
+    Stages slower than the baseline run of the same size, seed and shape by more than the tolerance,
+    the results without a shape having been generated with the default one.
+    """
+
+    def _key_(result: Dict) -> Tuple:
+        return (result['size'], result['seed']) + tuple(result.get(option, default) for option, default in SHAPE.items())
+
+    previous: Dict[Tuple, Dict] = {_key_(result): result for result in baseline['results']}
+    regressions: List[str] = list()
+
+    for result in results:
+        reference: Optional[Dict] = previous.get(_key_(result))
+        if reference is None:
+            continue
+        for stage in ['parse', 'detect', 'sum']:
+            if result[stage] > reference[stage] * (1 + tolerance) + slack:
+                regressions.append(f"size {result['size']} {stage}: {reference[stage]:.3f}s -> {result[stage]:.3f}s")
+        if result['conflicts'] != reference['conflicts']:
+            regressions.append(f"size {result['size']} conflicts: {reference['conflicts']} -> {result['conflicts']}")
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='time parsing, detection and summary on synthetic rule sets')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='numbers of rules, default 1000 10000 100000')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the generator, default 0')
+    parser.add_argument('--any_ratio', type=float, default=SHAPE['any_ratio'],
+                        help='share of ANY in the address and port fields, default 0.05')
+    parser.add_argument('--range_ratio', type=float, default=SHAPE['range_ratio'],
+                        help='share of ranges among the address and port objects, default 0.3')
+    parser.add_argument('--group_ratio', type=float, default=SHAPE['group_ratio'],
+                        help='share of comma-separated groups among the address and port objects, default 0.2')
+    parser.add_argument('--accept_ratio', type=float, default=SHAPE['accept_ratio'],
+                        help='share of accept rules, default 0.6')
+    parser.add_argument('--udp_ratio', type=float, default=SHAPE['udp_ratio'],
+                        help='share of udp among the ports, default 0.25')
+    parser.add_argument('--inactive_ratio', type=float, default=SHAPE['inactive_ratio'],
+                        help='share of disabled rules, default 0.02')
+    parser.add_argument('--subnets', type=int, default=SHAPE['subnets'],
+                        help='number of /24 subnets of 10.0.0.0/8 the addresses are drawn from, default 64')
+    parser.add_argument('--engine', type=str, default='auto', choices=['auto', 'python', 'numpy'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--prune', type=int, default=1)
+    parser.add_argument('--stream', type=int, default=1,
+                        help='if the conflicts are streamed into one file, default 1')
+    parser.add_argument('--out', type=str, default='bench.json',
+                        help='file of the results')
+    parser.add_argument('--baseline', type=str, default='',
+                        help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown reported as a regression, default 0.2')
+    parser.add_argument('--slack', type=float, default=0.05,
+                        help='absolute slowdown (seconds) ignored as noise, default 0.05')
+    parser.add_argument('--generate', type=str, default='',
+                        help='only write the rules of the first size and seed into this csv')
+    parser.add_argument('--kernel', type=int, default=0,
+                        help='only compare the detection engines with the reference on this number of random pairs')
+    parser.add_argument('--compaction', type=int, default=0,
+                        help='only check the compaction against the first-match classification on this number of '
+                             'rule sets')
+
+    args = parser.parse_args()
+
+    if args.kernel:
+        mismatches, seconds = compare_engines(args.kernel, args.seed)
+        print(f"pairs: {args.kernel}, mismatches: {mismatches}, "
+              f"{', '.join(f'{engine} {duration:.3f}s' for engine, duration in seconds.items())}")
+        sys.exit(1 if mismatches else 0)
+
+    if args.compaction:
+        mismatches, unproven = compare_compaction(args.compaction, args.seed)
+        print(f"rule sets: {args.compaction}, wrongly reported equivalent: {mismatches}, not proven: {unproven}")
+        sys.exit(1 if mismatches else 0)
+
+    if args.generate:
+        write_policies(args.generate, generate_policies(args.sizes[0], args.seed, **shape_of(args)))
+        sys.exit(0)
+
+    results: List[Dict[str, Union[int, float]]] = list()
+    for size in args.sizes:
+        result: Dict[str, Union[int, float]] = run_benchmark(size, args.seed, args)
+        print(f"size {size}: parse {result['parse']:.3f}s, detect {result['detect']:.3f}s, "
+              f"sum {result['sum']:.3f}s, conflicts {result['conflicts']}")
+        results.append(result)
+
+    with open(args.out, 'w') as f:
+        json.dump({
+            'version': 1,
+            'created': strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': getattr(patch.np, '__version__', None),
+            'options': {'engine': args.engine, 'workers': args.workers, 'prune': args.prune, 'stream': args.stream,
+                        **shape_of(args)},
+            'results': results
+        }, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions: List[str] = compare(results, json.load(f), args.tolerance, args.slack)
+        for regression in regressions:
+            print(f'regression: {regression}')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,215 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import argparse
+
+from time import perf_counter
+from itertools import product
+from collections import Counter
+from typing import List, Dict, Union, Tuple
+
+from tqdm import trange
+
+import patch
+from fleet import read_manifest
+
+ANOMALY_TYPES: List[str] = ['shadowing', 'spurious', 'redundant', 'correlated']
+
+
+def anomaly_of_relation(relation: int, upstream: bool, downstream: bool) -> str:
+    """
+    Anomaly between an upstream rule and a downstream rule on the path of the same packets, `relation` being the
+    relation of the upstream rule to the downstream one and the actions True for accept:
+    shadowing if the upstream firewall blocks all the packets accepted downstream, spurious if it accepts packets
+    all blocked downstream, redundant if the downstream rule blocks packets all blocked upstream already, and
+    correlated if the upstream firewall blocks or accepts only a part of such packets.
+    """
+    if not upstream and downstream:
+        return 'shadowing' if relation in [1, 3] else 'correlated'
+    if upstream and not downstream:
+        return 'spurious' if relation in [1, 2] else 'correlated'
+    if not upstream and not downstream and relation in [1, 3]:
+        return 'redundant'
+    return ''
+
+
+def protocol_relation(protocol_1: str, protocol_2: str) -> int:
+    # protocols are matched by name across devices, any being a superset of every protocol
+    protocol_1, protocol_2 = protocol_1.lower(), protocol_2.lower()
+    if protocol_1 == protocol_2:
+        return 1
+    if protocol_1 == 'any':
+        return 3
+    if protocol_2 == 'any':
+        return 2
+    return 0
+
+
+def socket(ip: patch.RangeColumn, ip_entry: int, port: patch.RangeColumn, port_entry: int) -> str:
+    return f"{patch.int2ip(ip.starts[ip_entry])}-{patch.int2ip(ip.ends[ip_entry])}:" \
+           f"{port.starts[port_entry]}-{port.ends[port_entry]}"
+
+
+def detect_anomalies_between_devices(upstream: patch.RuleTable, u: int, downstream: patch.RuleTable,
+                                     d: int) -> List[Dict[str, Union[int, str]]]:
+    """
+    The anomalies between rule u of the upstream firewall and rule d of the downstream one, for every combination
+    of their groups like detect_conflicts_between_policies, the protocol being one more dimension.
+    """
+    anomalies: List[Dict[str, Union[int, str]]] = list()
+    up, down = upstream, downstream
+
+    for src_ip_1, src_ip_2 in product(up.src_ip.span(u), down.src_ip.span(d)):
+        src_ip_relation: int = patch.find_relation_between_ranges(
+            up.src_ip.starts[src_ip_1], up.src_ip.ends[src_ip_1], down.src_ip.starts[src_ip_2], down.src_ip.ends[src_ip_2])
+        if not src_ip_relation:
+            continue
+
+        for src_port_1, src_port_2 in product(up.src_port.span(u), down.src_port.span(d)):
+            for dst_ip_1, dst_ip_2 in product(up.dst_ip.span(u), down.dst_ip.span(d)):
+                dst_ip_relation: int = patch.find_relation_between_ranges(
+                    up.dst_ip.starts[dst_ip_1], up.dst_ip.ends[dst_ip_1],
+                    down.dst_ip.starts[dst_ip_2], down.dst_ip.ends[dst_ip_2])
+                if not dst_ip_relation:
+                    continue
+                relation_ip: int = patch.find_relation_of_relations(dst_ip_relation, src_ip_relation)
+
+                for dst_port_1, dst_port_2 in product(up.dst_port.span(u), down.dst_port.span(d)):
+                    protocol_1: str = up.protocol_names[up.protocols[dst_port_1]]
+                    protocol_2: str = down.protocol_names[down.protocols[dst_port_2]]
+                    dst_port_relation: int = patch.find_relation_of_relations(
+                        patch.find_relation_between_ranges(
+                            up.dst_port.starts[dst_port_1], up.dst_port.ends[dst_port_1],
+                            down.dst_port.starts[dst_port_2], down.dst_port.ends[dst_port_2]),
+                        protocol_relation(protocol_1, protocol_2))
+                    if not dst_port_relation:
+                        continue
+
+                    relation: int = patch.find_relation_of_relations(relation_ip, dst_port_relation)
+                    anomaly: str = anomaly_of_relation(relation, bool(up.actions[u]), bool(down.actions[d]))
+                    if not anomaly:
+                        continue
+
+                    anomalies.append({
+                        'src_ip_rel': src_ip_relation, 'dst_ip_rel': dst_ip_relation, 'dst_port_rel': dst_port_relation,
+                        'relation_rel': relation, 'anomaly': anomaly, 'up': up.pids[u], 'down': down.pids[d],
+                        'up_src_socket': socket(up.src_ip, src_ip_1, up.src_port, src_port_1),
+                        'up_dst_socket': socket(up.dst_ip, dst_ip_1, up.dst_port, dst_port_1),
+                        'down_src_socket': socket(down.src_ip, src_ip_2, down.src_port, src_port_2),
+                        'down_dst_socket': socket(down.dst_ip, dst_ip_2, down.dst_port, dst_port_2),
+                        'protocol': f"up: {protocol_1}, down: {protocol_2}",
+                        'action': f"up: {up.action_name(u)}, down: {down.action_name(d)}"})
+    return anomalies
+
+
+def join_candidates(upstream: patch.RuleTable, u: int, index: patch.CandidateIndex) -> List[int]:
+    """The downstream rules overlapping rule u in every dimension, found by the interval trees of `index`."""
+    return index.select({
+        'src_ip': tuple((upstream.src_ip.starts[entry], upstream.src_ip.ends[entry])
+                        for entry in upstream.src_ip.span(u)),
+        'dst_ip': tuple((upstream.dst_ip.starts[entry], upstream.dst_ip.ends[entry])
+                        for entry in upstream.dst_ip.span(u)),
+        'dst_port': tuple((upstream.dst_port.starts[entry], upstream.dst_port.ends[entry],
+                           upstream.protocol_names[upstream.protocols[entry]]) for entry in upstream.dst_port.span(u))})
+
+
+def load_device(device: Dict[str, Union[int, str]], base: List[str]) -> patch.RuleTable:
+    """The active rules of a device, overauthorized ones included since they pass packets all the same."""
+    config = patch.build_parser().parse_args(base)
+    for key, value in device.items():
+        if key != 'name':
+            if not hasattr(config, key):
+                raise ValueError(f"unknown option {key} of device {device['name']}")
+            setattr(config, key, value)
+    config.test = 0
+
+    return patch.compile_rules((policy for policy in patch.read_policies(config) if not policy[config.inactive]),
+                               config)
+
+
+def detect_link(upstream: patch.RuleTable, downstream: patch.RuleTable,
+                stats: patch.Stats) -> List[Dict[str, Union[int, str]]]:
+    with stats.stage('index'):
+        index: patch.CandidateIndex = patch.CandidateIndex(downstream)
+
+    anomalies: List[Dict[str, Union[int, str]]] = list()
+    for u in trange(len(upstream)):
+        with stats.stage('join'):
+            candidates: List[int] = join_candidates(upstream, u, index)
+        with stats.stage('detection'):
+            stats.counters['pairs'] += len(candidates)
+            for d in candidates:
+                anomalies += detect_anomalies_between_devices(upstream, u, downstream, d)
+    return anomalies
+
+
+def list_devices(args) -> List[Dict[str, Union[int, str]]]:
+    devices: List[Dict[str, Union[int, str]]] = \
+        read_manifest(args.manifest) if args.manifest else [{'fpath': fpath} for fpath in args.chain]
+    for device in devices:
+        device.setdefault('name', os.path.splitext(os.path.basename(device['fpath']))[0])
+    if len(devices) < 2:
+        raise ValueError('a chain needs at least two devices')
+    return devices
+
+
+def write_chain(links: List[Dict], pairs: List[Dict[str, List[Tuple[str, str]]]], out: str, stats: patch.Stats):
+    with open(os.path.join(out, 'chain.json'), 'w') as f:
+        json.dump({'links': links, 'stages': stats.stages, 'pairs': stats.counters['pairs']}, f, indent=2)
+
+    with open(os.path.join(out, 'chain.txt'), 'w') as f:
+        for link, link_pairs in zip(links, pairs):
+            f.write(f"{link['upstream']} -> {link['downstream']}: {link['total']} anomalies\n")
+            for key in ANOMALY_TYPES:
+                f.write(f"\t{key.capitalize()}: {link['anomalies'][key]}\n")
+                for up, down in link_pairs[key]:
+                    f.write(f"\t\t{up}->{down}\n")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='detect the anomalies between consecutive firewalls of a path, the other arguments being passed '
+                    'to every device (e.g. --private_cloud=0), before the options of the manifest')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--chain', type=str, nargs='+', default=list(),
+                        help='csv files of the firewalls in the order of the path, all of them with the given columns')
+    source.add_argument('--manifest', type=str, default='',
+                        help='json list of the devices in the order of the path, with their fpath, name and options')
+    parser.add_argument('--out', type=str, default='chain/',
+                        help='directory of anomalies.jsonl, chain.txt and chain.json')
+
+    args, base = parser.parse_known_args()
+    patch.build_parser().parse_args(base)
+
+    devices: List[Dict[str, Union[int, str]]] = list_devices(args)
+    os.makedirs(args.out, exist_ok=True)
+    stats: patch.Stats = patch.Stats()
+
+    tables: List[patch.RuleTable] = list()
+    for device in devices:
+        with stats.stage('parse'):
+            tables.append(load_device(device, base))
+
+    links: List[Dict] = list()
+    pairs_of_links: List[Dict[str, List[Tuple[str, str]]]] = list()
+    with open(os.path.join(args.out, 'anomalies.jsonl'), 'w') as f:
+        for k in range(len(devices) - 1):
+            start: float = perf_counter()
+            anomalies: List[Dict[str, Union[int, str]]] = detect_link(tables[k], tables[k + 1], stats)
+
+            counts: Counter = Counter(anomaly['anomaly'] for anomaly in anomalies)
+            pairs: Dict[str, List[Tuple[str, str]]] = {key: list() for key in ANOMALY_TYPES}
+            for anomaly in anomalies:
+                pairs[anomaly['anomaly']].append((anomaly['up'], anomaly['down']))
+                anomaly.update(upstream=devices[k]['name'], downstream=devices[k + 1]['name'])
+                f.write(json.dumps(anomaly) + '\n')
+
+            links.append({'upstream': devices[k]['name'], 'downstream': devices[k + 1]['name'],
+                          'total': len(anomalies), 'anomalies': {key: counts[key] for key in ANOMALY_TYPES},
+                          'seconds': perf_counter() - start})
+            pairs_of_links.append(pairs)
+            print(f"{devices[k]['name']} -> {devices[k + 1]['name']}: {len(anomalies)} anomalies "
+                  f"({', '.join(f'{key} {counts[key]}' for key in ANOMALY_TYPES)})")
+
+    write_chain(links, pairs_of_links, args.out, stats)
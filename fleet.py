@@ -0,0 +1,172 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import json
+import argparse
+
+from glob import glob
+from time import perf_counter
+from multiprocessing import Pool
+from contextlib import redirect_stdout, redirect_stderr
+from typing import List, Dict, Union, Tuple
+
+import patch
+
+
+def read_manifest(path: str) -> List[Dict[str, Union[int, str]]]:
+    """
+    Devices of a JSON manifest: a list of {"fpath": ..., "name": ..., <patch.py options>}, e.g.
+    {"fpath": "fw1.csv", "src_ip": 3, "dst_ip": 6, "private_cloud": 0}. Relative paths are relative to the manifest.
+    """
+    with open(path, 'r') as f:
+        devices: List[Dict[str, Union[int, str]]] = json.load(f)
+
+    for device in devices:
+        if 'fpath' not in device:
+            raise ValueError(f'device without fpath in {path}: {device}')
+        device['fpath'] = os.path.join(os.path.dirname(path), device['fpath'])
+    return devices
+
+
+def list_devices(args) -> List[Dict[str, Union[int, str]]]:
+    if args.manifest:
+        devices: List[Dict[str, Union[int, str]]] = read_manifest(args.manifest)
+    else:
+        devices = [{'fpath': fpath} for fpath in sorted(glob(os.path.join(args.input, '*.csv')))]
+
+    names: set = set()
+    for device in devices:
+        device.setdefault('name', os.path.splitext(os.path.basename(device['fpath']))[0])
+        if device['name'] in names:
+            raise ValueError(f"duplicated device name {device['name']}")
+        names.add(device['name'])
+
+    # the largest files first, so that the pool is not left waiting for one of them at the end
+    return sorted(devices, key=lambda device: os.path.getsize(device['fpath']), reverse=True)
+
+
+def device_config(device: Dict[str, Union[int, str]], base: List[str], out: str):
+    directory: str = os.path.join(out, device['name'])
+    config = patch.build_parser().parse_args(base)
+
+    for key, value in device.items():
+        if key != 'name':
+            if not hasattr(config, key):
+                raise ValueError(f"unknown option {key} of device {device['name']}")
+            setattr(config, key, value)
+
+    # devices run in the processes of the fleet pool, which cannot start pools of their own
+    config.test, config.sum, config.workers, config.cache = 0, 1, 1, ''
+    config.cdir = os.path.join(directory, 'conflicts')
+    config.oa = os.path.join(directory, 'overauthorization.txt')
+    config.disable = os.path.join(directory, 'disable.txt')
+    config.report = os.path.join(directory, 'report.txt')
+    config.stats = os.path.join(directory, 'stats.json')
+    if config.residual:
+        config.residual = os.path.join(directory, 'dead.json')
+    return config
+
+
+def analyze_device(task: Tuple[Dict[str, Union[int, str]], List[str], str]) -> Dict:
+    """
+    Run detection and summary of one device, its output going to <out>/<name>/log.txt.
+    The parse caches of patch.py live as long as the worker process, so the address and port objects
+    shared by the devices of a worker are parsed once.
+    """
+    device, base, out = task
+    start: float = perf_counter()
+    result: Dict = {'name': device['name'], 'fpath': device['fpath']}
+
+    try:
+        config = device_config(device, base, out)
+        os.makedirs(config.cdir, exist_ok=True)
+
+        with open(os.path.join(out, device['name'], 'log.txt'), 'w') as log, redirect_stdout(log), redirect_stderr(log):
+            stats: patch.Stats = patch.Stats()
+            with stats.stage('clear'):
+                patch.clear_conflict(config)
+            patch.main(config, stats)
+            with stats.stage('summarize'):
+                patch.sum(config)
+            stats.dump(config.stats)
+
+        with open(os.path.splitext(config.report)[0] + '.json', 'r') as f:
+            report: Dict = json.load(f)
+
+        result.update(rules=stats.counters['rules'], overauthorized=stats.counters['overauthorized'],
+                      inactive=stats.counters['inactive'],
+                      dead=stats.counters['dead_rules'] if config.residual else None,
+                      total=report['total'], conflicts=report['conflicts'])
+    except Exception as error:
+        # whatever fails on one device is recorded in the summary, the other devices go on
+        result['error'] = f'{type(error).__name__}: {error}'
+
+    result['seconds'] = perf_counter() - start
+    result['worker'] = os.getpid()
+    result['parse_cache_hits'] = patch.parse_ip_groups.cache_info().hits + patch.parse_port_groups.cache_info().hits
+    return result
+
+
+def write_summary(results: List[Dict], out: str, seconds: float):
+    results = sorted(results, key=lambda result: result['name'])
+    failed: List[Dict] = [result for result in results if 'error' in result]
+    done: List[Dict] = [result for result in results if 'error' not in result]
+
+    conflicts: Dict[str, int] = {key: sum(result['conflicts'][key] for result in done) for key in patch.CONFLICT_TYPES}
+    summary: Dict = {
+        'devices': len(results),
+        'failed': len(failed),
+        'seconds': seconds,
+        'rules': sum(result['rules'] for result in done),
+        'total': sum(result['total'] for result in done),
+        'conflicts': conflicts,
+        'results': results
+    }
+    with open(os.path.join(out, 'fleet.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    with open(os.path.join(out, 'fleet.txt'), 'w') as f:
+        f.write(f"Devices: {len(results)}, failed: {len(failed)}, rules: {summary['rules']}, "
+                f"conflicts: {summary['total']}\n")
+        for key in patch.CONFLICT_TYPES:
+            f.write(f"\t{key.capitalize()}: {conflicts[key]}\n")
+        f.write('\n')
+        for result in sorted(done, key=lambda result: result['total'], reverse=True):
+            counts: str = ', '.join(f'{key} {result[key]}' for key in ['overauthorized', 'inactive', 'dead']
+                                    if result[key] is not None)
+            f.write(f"{result['name']}: {result['total']} conflicts in {result['rules']} rules ({counts})\n")
+        for result in failed:
+            f.write(f"{result['name']}: failed, {result['error']}\n")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='detect the conflicts of many firewalls, the other arguments being passed to every device '
+                    '(e.g. --private_cloud=0 --coalesce=1), before the options of the manifest')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--input', type=str, default='',
+                        help='directory of the csv files, all of them with the given columns')
+    source.add_argument('--manifest', type=str, default='',
+                        help='json list of the devices with their fpath, name and patch.py options')
+    parser.add_argument('--out', type=str, default='fleet/',
+                        help='directory of the per-device outputs and of fleet.json / fleet.txt')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='devices analyzed at the same time, default the number of cpus')
+
+    args, base = parser.parse_known_args()
+    patch.build_parser().parse_args(base)
+
+    devices: List[Dict[str, Union[int, str]]] = list_devices(args)
+    os.makedirs(args.out, exist_ok=True)
+
+    start: float = perf_counter()
+    results: List[Dict] = list()
+    with Pool(max(min(args.processes, len(devices)), 1)) as pool:
+        for result in pool.imap_unordered(analyze_device, [(device, base, args.out) for device in devices]):
+            status: str = result['error'] if 'error' in result else f"{result['total']} conflicts"
+            print(f"[{len(results) + 1}/{len(devices)}] {result['name']}: {status} ({result['seconds']:.2f}s)")
+            results.append(result)
+
+    write_summary(results, args.out, perf_counter() - start)
+    sys.exit(1 if any('error' in result for result in results) else 0)
@@ -3,12 +3,30 @@
 # date: 2023/03/21/
 import os
 import csv
+import gzip
 import json
+import heapq
+import struct
+import hashlib
 import argparse
-
-from tqdm import trange
-from itertools import product
-from typing import List, Dict, Union, Optional
+import builtins
+import tempfile
+
+from tqdm import tqdm, trange
+from array import array
+from time import perf_counter
+from contextlib import contextmanager
+from functools import partial, lru_cache
+from multiprocessing import Pool
+from itertools import product, islice
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from typing import List, Dict, Union, Optional, Iterable, Iterator, Tuple, Callable, TextIO
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 idx2conflict: Dict[int, str] = {
@@ -23,6 +41,46 @@ idx2conflict: Dict[int, str] = {
 conflict2idx: Dict[str, int] = {conflict: idx for idx, conflict in idx2conflict.items()}
 
 
+class Stats:
+    """
+    Wall time of the stages and counters of the hot paths, dumped by --stats.
+    Stages can be nested, the time of a stage excluding the stages entered inside it.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, float] = dict()
+        self.counters: Counter = Counter()
+        self.stack: List[str] = list()
+        self.mark: float = perf_counter()
+
+    def _switch_(self):
+        now: float = perf_counter()
+        if self.stack:
+            self.stages[self.stack[-1]] += now - self.mark
+        self.mark = now
+
+    @contextmanager
+    def stage(self, name: str):
+        self._switch_()
+        self.stages.setdefault(name, 0.0)
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self._switch_()
+            self.stack.pop()
+
+    def count_conflicts(self, conflicts: List[Union[Dict[str, Union[int, str]], bytes]]):
+        for conflict in conflicts:
+            name: str = conflict['conflict'] if isinstance(conflict, dict) else CONFLICT_TYPES[conflict[-1]]
+            self.counters[f"conflicts_{name}"] += 1
+
+    def dump(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({'stages': self.stages, 'total': builtins.sum(self.stages.values()),
+                       'counters': dict(self.counters)}, f, indent=2)
+
+
 class Policy:
 
     __slots__ = ['pid', 'protocol', 'inactive', 'action', 'dst_ip_start', 'dst_ip_end', 'dst_port_start', 'dst_port_end',
@@ -53,12 +111,14 @@ class Policy:
         self.dst_port_end: int = dst_port['end']
 
 
-    def boolean_action(self, action: str) -> bool:
+    @staticmethod
+    def boolean_action(action: str) -> bool:
         if action.lower() in ['f', '0', 'n', 'no', 'deny', 'reject']:
             return False
         return True
 
-    def transform_protocol(self, protocol):
+    @staticmethod
+    def transform_protocol(protocol):
         if protocol.lower() in ['*', 'any', '0']:
             return 'any'
         else:
@@ -67,6 +127,9 @@ class Policy:
 
 def find_relation_between_ranges(start_1: int, end_1: int, start_2: int, end_2: int) -> int:
 
+    if end_1 < start_2 or end_2 < start_1:
+        return 0
+
     if start_1 == end_1 and start_2 == end_2:
         if start_1 == start_2:
             return 1
@@ -115,6 +178,27 @@ def action_relation_pack(src_ip, dst_ip, src_port, dst_port, relation, action, c
             'relation_rel': relation, 'action_rel': action, 'conflict': conflict}
 
 
+def conflict_of_relation(relation: int, action: int) -> str:
+    if action:
+        if relation == 3:
+            return 'redundant'
+        elif relation == 2 or relation == 1:
+            return 'redundant'
+        else:
+            return 'correlated'
+    else:
+        if relation == 1:
+            return 'shadowed'
+        elif relation == 2:
+            return 'general'
+        elif relation == 3:
+            return 'shadowed'
+        elif relation == 4:
+            return 'correlated'
+        else:
+            return ''
+
+
 def _detect_conflict_between_pure_(policy_1: Policy, policy_2: Policy) -> Dict[str, Union[int, str]]:
     # protocol -> src_ip -> src_port -> dst_ip -> dst_port
 
@@ -153,88 +237,168 @@ def _detect_conflict_between_pure_(policy_1: Policy, policy_2: Policy) -> Dict[s
     relation: int = find_relation_of_relations(relation, dst_port_relation)
     action: int = int(policy_2.action == policy_1.action)
 
-    if action:
-        if relation == 3:
-            conflict = 'redundant'
-        elif relation == 2 or relation == 1:
-            conflict = 'redundant'
-        else:
-            conflict = 'correlated'
-    else:
-        if relation == 1:
-            conflict = 'shadowed'
-        elif relation == 2:
-            conflict = 'general'
-        elif relation == 3:
-            conflict = 'shadowed'
-        elif relation == 4:
-            conflict = 'correlated'
-        else:
-            return action_relation_pack(0, 0, 0, 0, 0, 0, '')
+    conflict: str = conflict_of_relation(relation, action)
+    if not conflict:
+        return action_relation_pack(0, 0, 0, 0, 0, 0, '')
     pack = action_relation_pack(src_ip_relation, dst_ip_relation, 1, dst_port_relation, relation, action, conflict)
     return pack
 
 
-def start_end_pack(start, end) -> Dict[str, Union[str, int]]:
-    return {'start': start, 'end': end}
+# find_relation_of_relations and conflict_of_relation as tables, [relation_1][relation_2] and [action][relation]
+RELATION_OF_RELATIONS: List[List[int]] = [
+    [find_relation_of_relations(relation_1, relation_2) for relation_2 in range(5)] for relation_1 in range(5)]
+CONFLICT_OF_RELATION: List[List[str]] = [
+    [conflict_of_relation(relation, action) if relation else '' for relation in range(5)] for action in range(2)]
 
 
-def find_range(stream: str) -> Dict[str, str]:
-    if '-' in stream:
-        temp: List[str] = stream.split('-')
-        return start_end_pack(temp[0], temp[1])
-    else:
-        return start_end_pack(stream, stream)
+def ip2int(address: str) -> int:
+    octets: List[str] = address.strip().split('.')
+    if len(octets) != 4:
+        raise ValueError(f"malformed ip address '{address}'")
+
+    value: int = 0
+    for octet in octets:
+        if not octet.isdigit() or int(octet) > 255:
+            raise ValueError(f"malformed ip address '{address}'")
+        value = value << 8 | int(octet)
+    return value
+
+
+# identical groups parsed from different strings share one tuple
+_interned_groups_: Dict[tuple, tuple] = dict()
 
 
-def parse_ip_groups(ip: str) -> List[Dict[str, str]]:
+def intern_group(group: tuple) -> tuple:
+    return _interned_groups_.setdefault(group, group)
+
+
+@lru_cache(maxsize=None)
+def parse_ip_groups(ip: str) -> Tuple[Tuple[int, int], ...]:
     if ip.lower() in ['any', '0.0.0.0', '*.*.*.*']:
-        return [start_end_pack('0.0.0.0', '255.255.255.255')]
+        return intern_group(((0, 4294967295), ))
 
-    _ip_groups: List[str] = ip.replace(" ", "").split(',')
-    ip_groups: List[Dict[str, str]] = list()
+    ip_groups: List[Tuple[int, int]] = list()
 
-    for _ip in _ip_groups:
-        ip_groups.append(find_range(_ip))
+    for _ip in ip.replace(" ", "").split(','):
+        bounds: List[str] = _ip.split('-')
+        if len(bounds) > 2 or not all(bounds):
+            raise ValueError(f"malformed ip range '{_ip}' in '{ip}'")
 
-    return ip_groups
+        start, end = ip2int(bounds[0]), ip2int(bounds[-1])
+        if start > end:
+            raise ValueError(f"ip range '{_ip}' ends before it starts")
+        ip_groups.append((start, end))
 
+    return intern_group(tuple(ip_groups))
 
-def parse_port_groups(port: str, if_prot: bool) -> List[Dict[str, Union[str, int]]]:
-    if port.lower() == 'any':
-        pack = start_end_pack(0, 65535)
-        if if_prot:
-            pack['protocol'] = 'any'
-        return [pack]
 
-    _port_groups: List[str] = port.replace(' ', '').split(',')
-    port_groups: List[Dict[str, Union[str, int]]] = list()
-    temp: Optional[str] = None
+@lru_cache(maxsize=None)
+def parse_port_groups(port: str, if_prot: bool) -> Tuple[Tuple[int, int, str], ...]:
+    """Port ranges with their protocols (transformed by Policy), the protocol is empty if not combined."""
+    if port.lower() in ['any', '*']:
+        return intern_group(((0, 65535, 'any' if if_prot else ''), ))
 
-    for _port in _port_groups:
+    port_groups: List[Tuple[int, int, str]] = list()
+    protocol: str = ''
+
+    for _port in port.replace(' ', '').split(','):
+        stream: str = _port
         if if_prot:
-            temp = _port.split('_')
-            _port = temp[1]
+            temp: List[str] = _port.split('_')
+            if len(temp) != 2:
+                raise ValueError(f"port '{_port}' in '{port}' is not combined with a protocol (e.g. tcp_80)")
+            protocol, stream = Policy.transform_protocol(temp[0]), temp[1]
 
-        pack: Dict[str, Union[int, str]] = find_range(_port)
-        pack['start'] = int(pack['start'])
-        pack['end'] = int(pack['end'])
+        bounds: List[str] = stream.split('-')
+        if len(bounds) > 2 or not all(bound.isdigit() for bound in bounds):
+            raise ValueError(f"malformed port range '{_port}' in '{port}'")
 
-        if if_prot:
-            pack['protocol'] = temp[0]
+        start, end = int(bounds[0]), int(bounds[-1])
+        if end > 65535 or start > end:
+            raise ValueError(f"port range '{_port}' is out of 0-65535 or ends before it starts")
+        port_groups.append((start, end, protocol))
 
-        port_groups.append(pack)
+    return intern_group(tuple(port_groups))
 
-    return port_groups
 
+@lru_cache(maxsize=None)
+def with_protocol(port_groups: Tuple[Tuple[int, int, str], ...], protocol: str) -> Tuple[Tuple[int, int, str], ...]:
+    return intern_group(tuple((start, end, Policy.transform_protocol(protocol)) for start, end, _ in port_groups))
 
-def parse_fields(policy: List[str], config) -> Dict[str, List[Dict[str, Union[str, int]]]]:
 
-    src_ip: List[Dict[str, str]] = parse_ip_groups(policy[config.src_ip])
-    dst_ip: List[Dict[str, str]] = parse_ip_groups(policy[config.dst_ip])
+def parse_cidr_groups(ip: str) -> Tuple[Tuple[int, int], ...]:
+    """The formats of parse_ip_groups plus CIDR blocks, e.g. '10.20.0.0/16,10.30.0.1'."""
+    groups: List[Tuple[int, int]] = list()
+    for _ip in ip.replace(' ', '').split(','):
+        if '/' not in _ip:
+            groups += parse_ip_groups(_ip)
+            continue
 
-    src_port: List[Dict[str, Union[str, int]]] = parse_port_groups(policy[config.src_port], config.protocol < 0)
-    dst_port: List[Dict[str, Union[str, int]]] = parse_port_groups(policy[config.dst_port], config.protocol < 0)
+        address, prefix = _ip.split('/', 1)
+        if not prefix.isdigit() or int(prefix) > 32:
+            raise ValueError(f"malformed cidr block '{_ip}'")
+        size: int = 1 << (32 - int(prefix))
+        start: int = ip2int(address) & ~(size - 1)
+        groups.append((start, start + size - 1))
+    return tuple(groups)
+
+
+def parse_scope(scope: str) -> Dict[str, Union[str, tuple]]:
+    """
+    Filters of --scope, separated by spaces: src_ip, dst_ip and ip (source or destination) take ip groups or CIDR
+    blocks, dst_port takes port groups optionally combined with a protocol, protocol a protocol name,
+    e.g. 'ip=10.20.0.0/16 dst_port=tcp_443' or 'dst_ip=10.20.0.0/16 dst_port=443,8443 protocol=tcp'.
+    """
+    filters: Dict[str, Union[str, tuple]] = dict()
+    for item in scope.split():
+        key, _, value = item.partition('=')
+        if not value:
+            raise ValueError(f"malformed scope filter '{item}', expected field=value")
+
+        if key in ['src_ip', 'dst_ip', 'ip']:
+            filters[key] = parse_cidr_groups(value)
+        elif key == 'dst_port':
+            filters[key] = parse_port_groups(value, '_' in value)
+        elif key == 'protocol':
+            filters[key] = Policy.transform_protocol(value)
+        else:
+            raise ValueError(f"unknown scope field '{key}', expected src_ip, dst_ip, ip, dst_port or protocol")
+
+    if not filters:
+        raise ValueError('empty scope')
+    return filters
+
+
+@lru_cache(maxsize=None)
+def coalesce_group(group: tuple) -> tuple:
+    """
+    Sort the ranges of a group and merge the overlapping or adjacent ones, port ranges only
+    being merged with ranges of the same protocol.
+    """
+    merged: List[tuple] = list()
+    for bounds in sorted(group, key=lambda bounds: (bounds[2:], bounds[0], bounds[1])):
+        if merged and merged[-1][2:] == bounds[2:] and bounds[0] <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], bounds[1])) + bounds[2:]
+        else:
+            merged.append(bounds)
+    return intern_group(tuple(merged))
+
+
+def parse_fields(policy: List[str], config) -> Dict[str, tuple]:
+    try:
+        src_ip: Tuple[Tuple[int, int], ...] = parse_ip_groups(policy[config.src_ip])
+        dst_ip: Tuple[Tuple[int, int], ...] = parse_ip_groups(policy[config.dst_ip])
+
+        src_port: Tuple[Tuple[int, int, str], ...] = parse_port_groups(policy[config.src_port], config.protocol < 0)
+        dst_port: Tuple[Tuple[int, int, str], ...] = parse_port_groups(policy[config.dst_port], config.protocol < 0)
+    except ValueError as error:
+        raise ValueError(f"rule {policy[config.id]}: {error}") from None
+
+    if config.protocol >= 0:
+        dst_port = with_protocol(dst_port, policy[config.protocol])
+
+    if config.coalesce:
+        src_ip, src_port, dst_ip, dst_port = map(coalesce_group, (src_ip, src_port, dst_ip, dst_port))
 
     return {
         'src_ip': src_ip,
@@ -244,17 +408,223 @@ def parse_fields(policy: List[str], config) -> Dict[str, List[Dict[str, Union[st
     }
 
 
-def decimalize(ip_group: Dict[str, str]) -> Dict[str, int]:
-    def _decimalize_(ip_addr: str) -> int:
-        ip_spaces: List[str] = ip_addr.strip().split('.')
-        binary_spaces: List[str] = [bin(int(i))[2:].zfill(8) for i in ip_spaces]
-        binary_stream: str = ''.join(binary_spaces)
-        integers: int = int(binary_stream, base=2)
-        return integers
-    return dict(start=_decimalize_(ip_group['start']), end=_decimalize_(ip_group['end']))
+def int2ip(value: int) -> str:
+    return f"{value >> 24 & 255}.{value >> 16 & 255}.{value >> 8 & 255}.{value & 255}"
+
+
+class RangeColumn:
+    """
+    One dimension of a RuleTable: every distinct group is stored once in the start/end arrays,
+    group g occupying [offsets[g], offsets[g+1]), and rule i refers to group groups[i].
+    """
+
+    __slots__ = ['starts', 'ends', 'offsets', 'groups', 'interned', 'owners']
+
+    def __init__(self):
+        self.starts: array = array('q')
+        self.ends: array = array('q')
+        self.offsets: array = array('q', [0])
+        self.groups: array = array('q')
+        self.interned: Dict[tuple, int] = dict()
+        # the first rule of every group
+        self.owners: array = array('q')
+
+    def append(self, ranges: tuple) -> bool:
+        """Refer the next rule to the group of `ranges`, return if the group is new."""
+        group: Optional[int] = self.interned.get(ranges)
+        new: bool = group is None
+
+        if new:
+            group = len(self.offsets) - 1
+            for bounds in ranges:
+                self.starts.append(bounds[0])
+                self.ends.append(bounds[1])
+            self.offsets.append(len(self.starts))
+            self.interned[ranges] = group
+            self.owners.append(len(self.groups))
+
+        self.groups.append(group)
+        return new
+
+    def pop(self, ranges: tuple) -> bool:
+        """Remove the last rule, `ranges` being its group, return if the group is removed with it."""
+        group: int = self.groups.pop()
+        if self.owners[group] != len(self.groups):
+            return False
+
+        del self.starts[self.offsets[group]:], self.ends[self.offsets[group]:]
+        self.offsets.pop()
+        self.owners.pop()
+        # groups of a mapped table are not interned
+        self.interned.pop(ranges, None)
+        return True
+
+    def span(self, rule: int) -> range:
+        group: int = self.groups[rule]
+        return range(self.offsets[group], self.offsets[group + 1])
 
 
-def detect_conflicts_between_policies(policy_1: List[str], policy_2: List[str], config) -> List[Dict[str, int]]:
+class RuleTable:
+    """
+    Columnar form of the resolved rules, compiled once by `compile_rules`.
+    Protocol codes are aligned with the dst_port ranges since the protocol may be combined with the port.
+    """
+
+    __slots__ = ['pids', 'actions', 'inactive', 'action_ids', 'action_names', 'action_codes', 'protocols',
+                 'protocol_names', 'protocol_codes', 'src_ip', 'src_port', 'dst_ip', 'dst_port', 'mapped', 'buffer']
+
+    def __init__(self):
+        self.pids: List[str] = list()
+        self.actions: bytearray = bytearray()
+        self.inactive: bytearray = bytearray()
+
+        self.action_ids: array = array('q')
+        self.action_names: List[str] = list()
+        self.action_codes: Dict[str, int] = dict()
+
+        self.protocols: array = array('q')
+        self.protocol_names: List[str] = list()
+        self.protocol_codes: Dict[str, int] = dict()
+
+        self.src_ip: RangeColumn = RangeColumn()
+        self.src_port: RangeColumn = RangeColumn()
+        self.dst_ip: RangeColumn = RangeColumn()
+        self.dst_port: RangeColumn = RangeColumn()
+
+        # file of the compiled table whose arrays are memory views of, see map_table
+        self.mapped: str = ''
+        self.buffer = None
+
+    def __len__(self) -> int:
+        return len(self.pids)
+
+    def __reduce_ex__(self, protocol):
+        # workers map the file again instead of receiving a copy of the arrays
+        if self.mapped:
+            return map_rules, (self.mapped, )
+        return super().__reduce_ex__(protocol)
+
+    def unmap(self):
+        """Copy the memory views of a mapped table into arrays, so that rules can be appended."""
+        for name, typecode in TABLE_ARRAYS:
+            value = getattr_path(self, name)
+            if isinstance(value, memoryview):
+                setattr_path(self, name, bytearray(value) if typecode == 'B' else array(typecode, value))
+        self.mapped, self.buffer = '', None
+
+    def action_name(self, rule: int) -> str:
+        return self.action_names[self.action_ids[rule]]
+
+    def append(self, policy: List[str], config):
+        # every field is read and parsed before the table changes, a malformed rule leaving it as it was
+        socket: Dict[str, tuple] = parse_fields(policy, config)
+        pid, action, inactive = policy[config.id], policy[config.action], policy[config.inactive]
+
+        self.pids.append(pid)
+        self.actions.append(Policy.boolean_action(action))
+        self.inactive.append(bool(inactive))
+        self.action_ids.append(intern_name(self.action_names, self.action_codes, action))
+
+        self.src_ip.append(socket['src_ip'])
+        self.dst_ip.append(socket['dst_ip'])
+        self.src_port.append(socket['src_port'])
+
+        if self.dst_port.append(socket['dst_port']):
+            for _, _, protocol in socket['dst_port']:
+                self.protocols.append(intern_name(self.protocol_names, self.protocol_codes, protocol))
+
+    def pop(self, policy: List[str], config):
+        """Remove the last rule, appended from `policy`; the names it interned are kept."""
+        socket: Dict[str, tuple] = parse_fields(policy, config)
+
+        self.pids.pop()
+        self.actions.pop()
+        self.inactive.pop()
+        self.action_ids.pop()
+
+        self.src_ip.pop(socket['src_ip'])
+        self.dst_ip.pop(socket['dst_ip'])
+        self.src_port.pop(socket['src_port'])
+
+        if self.dst_port.pop(socket['dst_port']):
+            del self.protocols[len(self.dst_port.starts):]
+
+
+def intern_name(names: List[str], codes: Dict[str, int], name: str) -> int:
+    if name not in codes:
+        codes[name] = len(names)
+        names.append(name)
+    return codes[name]
+
+
+def protocols_meet(table: RuleTable, protocol_1: int, protocol_2: int) -> bool:
+    """If packets of both protocol codes can be the same, protocol any matching every protocol."""
+    if protocol_1 == protocol_2:
+        return True
+    names: Tuple[str, str] = (table.protocol_names[protocol_1].lower(), table.protocol_names[protocol_2].lower())
+    return names[0] == names[1] or 'any' in names
+
+
+def compile_rules(policies: Iterable[List[str]], config) -> RuleTable:
+    table: RuleTable = RuleTable()
+    for policy in policies:
+        table.append(policy, config)
+    return table
+
+
+def socket_pack(table: RuleTable, i: int, j: int, entries: Tuple[int, ...],
+                conflict: Dict[str, Union[int, str]]) -> Dict[str, Union[int, str]]:
+    """
+    Describe the conflicting groups of rules i and j, `entries` being the column positions
+    (src_ip_1, src_ip_2, src_port_1, src_port_2, dst_ip_1, dst_ip_2, dst_port_1, dst_port_2).
+    """
+    src_ip_1, src_ip_2, src_port_1, src_port_2, dst_ip_1, dst_ip_2, dst_port_1, dst_port_2 = entries
+    src_ip, src_port, dst_ip, dst_port = table.src_ip, table.src_port, table.dst_ip, table.dst_port
+
+    conflict['pre'] = table.pids[i]
+    conflict['sub'] = table.pids[j]
+    conflict['pre_src_socket'] = \
+        f"{int2ip(src_ip.starts[src_ip_1])}-{int2ip(src_ip.ends[src_ip_1])}:" \
+        f"{src_port.starts[src_port_1]}-{src_port.ends[src_port_1]}"
+    conflict['pre_dst_socket'] = \
+        f"{int2ip(dst_ip.starts[dst_ip_1])}-{int2ip(dst_ip.ends[dst_ip_1])}:" \
+        f"{dst_port.starts[dst_port_1]}-{dst_port.ends[dst_port_1]}"
+    conflict['sub_src_socket'] = \
+        f"{int2ip(src_ip.starts[src_ip_2])}-{int2ip(src_ip.ends[src_ip_2])}:" \
+        f"{src_port.starts[src_port_2]}-{src_port.ends[src_port_2]}"
+    conflict['sub_dst_socket'] = \
+        f"{int2ip(dst_ip.starts[dst_ip_2])}-{int2ip(dst_ip.ends[dst_ip_2])}:" \
+        f"{dst_port.starts[dst_port_2]}-{dst_port.ends[dst_port_2]}"
+    conflict['protocol'] = \
+        f"pre: {table.protocol_names[table.protocols[dst_port_1]]}, " \
+        f"sub: {table.protocol_names[table.protocols[dst_port_2]]}"
+    conflict['action'] = f"pre: {table.action_name(i)}, sub: {table.action_name(j)}"
+    return conflict
+
+
+# conflict of --memory: i, j, the entries of socket_pack, the relations of action_relation_pack and the conflict type,
+# big-endian so that sorting the records as bytes sorts them in detection order
+RECORD: struct.Struct = struct.Struct('>10I7B')
+
+
+def record_pack(table: RuleTable, i: int, j: int, entries: Tuple[int, ...],
+                conflict: Dict[str, Union[int, str]]) -> bytes:
+    """The fixed-width record of the conflict of socket_pack, the sockets being rendered by render_record."""
+    return RECORD.pack(i, j, *entries, conflict['src_ip_rel'], conflict['dst_ip_rel'], conflict['src_port_rel'],
+                       conflict['dst_port_rel'], conflict['relation_rel'], conflict['action_rel'],
+                       CONFLICT_TYPES.index(conflict['conflict']))
+
+
+def render_record(table: RuleTable, record: bytes) -> Dict[str, Union[int, str]]:
+    i, j, *fields = RECORD.unpack(record)
+    src_ip, dst_ip, src_port, dst_port, relation, action, conflict = fields[8:]
+    return socket_pack(table, i, j, tuple(fields[:8]), action_relation_pack(
+        src_ip, dst_ip, src_port, dst_port, relation, action, CONFLICT_TYPES[conflict]))
+
+
+def detect_conflicts_between_policies(table: RuleTable, i: int, j: int,
+                                      pack: Callable[..., Union[Dict, bytes]] = socket_pack) \
+        -> List[Dict[str, Union[int, str]]]:
     """
     IP
     1. 'ANY'
@@ -274,88 +644,774 @@ def detect_conflicts_between_policies(policy_1: List[str], policy_2: List[str],
     3. protocol + ports
     """
 
-    conflicts: List[Dict[str, Union[int, str]]] = list()
+    # the most selective dimensions first, protocol with dst_port, then dst_ip and src_ip, the pair being left
+    # on the first of them without any overlapping groups; the src_port groups are not related
+    dst_ports: List[Tuple[int, int, int]] = related_entries(table.dst_port, i, j, table.protocols)
+    if not dst_ports:
+        return list()
+    dst_ips: List[Tuple[int, int, int]] = related_entries(table.dst_ip, i, j)
+    if not dst_ips:
+        return list()
+    src_ips: List[Tuple[int, int, int]] = related_entries(table.src_ip, i, j)
+    if not src_ips:
+        return list()
 
-    socket_1: Dict[str, List[Dict[str, Union[str, int]]]] = parse_fields(policy_1, config)
-    socket_2: Dict[str, List[Dict[str, Union[str, int]]]] = parse_fields(policy_2, config)
+    conflicts: List[Dict[str, Union[int, str]]] = list()
+    action: int = int(table.actions[i] == table.actions[j])
+    names: List[str] = CONFLICT_OF_RELATION[action]
+    src_ports: List[Tuple[int, int]] = list(product(table.src_port.span(i), table.src_port.span(j)))
+
+    # the conflicts in the order of the nested group loops src_ip, src_port, dst_ip, dst_port
+    for src_ip_1, src_ip_2, src_ip_relation in src_ips:
+        for src_port_1, src_port_2 in src_ports:
+            for dst_ip_1, dst_ip_2, dst_ip_relation in dst_ips:
+                relations: List[int] = RELATION_OF_RELATIONS[RELATION_OF_RELATIONS[dst_ip_relation][src_ip_relation]]
+
+                for dst_port_1, dst_port_2, dst_port_relation in dst_ports:
+                    relation: int = relations[dst_port_relation]
+                    if not names[relation]:
+                        continue
+
+                    conflict: Dict[str, Union[int, str]] = action_relation_pack(
+                        src_ip_relation, dst_ip_relation, 1, dst_port_relation, relation, action, names[relation])
+                    conflicts.append(pack(table, i, j, (src_ip_1, src_ip_2, src_port_1, src_port_2,
+                                                        dst_ip_1, dst_ip_2, dst_port_1, dst_port_2), conflict))
+    return conflicts
 
-    print(policy_1[config.id], policy_2[config.id])
 
-    if config.protocol >= 0:
-        protocol_1: Optional[str] = policy_1[config.protocol]
-        protocol_2: Optional[str] = policy_2[config.protocol]
-
-        for src_ip_1, src_ip_2 in product(socket_1['src_ip'], socket_2['src_ip']):
-            for src_port_1, src_port_2 in product(socket_1['src_port'], socket_2['src_port']):
-                for dst_ip_1, dst_ip_2 in product(socket_1['dst_ip'], socket_2['dst_port']):
-                    for dst_port_1, dst_port_2 in product(socket_1['dst_port'], socket_2['dst_port']):
-                        p1 = Policy(pid=policy_1[config.id], protocol=protocol_1,
-                                    src_ip=decimalize(src_ip_1), src_port=src_port_1,
-                                    dst_ip=decimalize(dst_ip_1), dst_port=dst_port_1,
-                                    inactive=policy_1[config.inactive], action=policy_1[config.action]
-                                    )
-                        p2 = Policy(pid=policy_2[config.id], protocol=protocol_2,
-                                    src_ip=decimalize(src_ip_2), src_port=src_port_2,
-                                    dst_ip=decimalize(dst_ip_2), dst_port=dst_port_2,
-                                    inactive=policy_2[config.inactive], action=policy_2[config.action]
-                                    )
-                        conflict: Dict[str, Union[int, str]] = _detect_conflict_between_pure_(p1, p2)
-                        conflict['pre'] = p1.pid
-                        conflict['sub'] = p2.pid
-                        if conflict['conflict']:
-                            conflict[
-                                'pre_src_socket'] = f"{src_ip_1['start']}-{src_ip_1['end']}:{src_port_1['start']}-{src_port_1['end']}"
-                            conflict[
-                                'pre_dst_socket'] = f"{dst_ip_1['start']}-{dst_ip_1['end']}:{dst_port_1['start']}-{dst_port_1['end']}"
-                            conflict[
-                                'sub_src_socket'] = f"{src_ip_2['start']}-{src_ip_2['end']}:{src_port_2['start']}-{src_port_2['end']}"
-                            conflict[
-                                'sub_dst_socket'] = f"{dst_ip_2['start']}-{dst_ip_2['end']}:{dst_port_2['start']}-{dst_port_2['end']}"
-                            conflict['protocol'] = f"pre: {p1.protocol}, sub: {p2.protocol}"
-                            conflict['action'] = f"pre: {policy_1[config.action]}, sub: {policy_2[config.action]}"
-                            conflicts.append(conflict)
+def related_entries(column: RangeColumn, i: int, j: int,
+                    protocols: Optional[array] = None) -> List[Tuple[int, int, int]]:
+    """
+    The pairs of groups of rules i and j in `column` with their relation, in the order of product, leaving out the
+    disjoint ones and, given the `protocols` of the entries, those of different protocols.
+    """
+    starts, ends, offsets = column.starts, column.ends, column.offsets
+    group_1, group_2 = column.groups[i], column.groups[j]
+    entries_2: range = range(offsets[group_2], offsets[group_2 + 1])
+
+    related: List[Tuple[int, int, int]] = list()
+    for entry_1 in range(offsets[group_1], offsets[group_1 + 1]):
+        start_1, end_1 = starts[entry_1], ends[entry_1]
+        for entry_2 in entries_2:
+            # the disjoint ranges, most of them, are left before relating the others
+            if end_1 < starts[entry_2] or ends[entry_2] < start_1:
+                continue
+            if protocols is not None and protocols[entry_1] != protocols[entry_2]:
+                continue
+            related.append((entry_1, entry_2,
+                            find_relation_between_ranges(start_1, end_1, starts[entry_2], ends[entry_2])))
+    return related
+
+
+def relation_between_groups(column: RangeColumn, entries_1: Iterable[int],
+                            entries_2: Iterable[int]) -> Tuple[int, List[int], List[int]]:
+    """
+    Relation between two coalesced groups (sorted disjoint ranges) as sets, found by one merge pass,
+    with the entries of each group overlapping the other group.
+    The relation is the one of find_relation_between_ranges when both groups are single ranges.
+    """
+    starts, ends = column.starts, column.ends
+    entries_1, entries_2 = list(entries_1), list(entries_2)
+    size_1: int = builtins.sum(ends[entry] - starts[entry] + 1 for entry in entries_1)
+    size_2: int = builtins.sum(ends[entry] - starts[entry] + 1 for entry in entries_2)
+
+    common: int = 0
+    hits_1: List[int] = list()
+    hits_2: List[int] = list()
+    k_1, k_2 = 0, 0
+
+    while k_1 < len(entries_1) and k_2 < len(entries_2):
+        entry_1, entry_2 = entries_1[k_1], entries_2[k_2]
+        start: int = max(starts[entry_1], starts[entry_2])
+        end: int = min(ends[entry_1], ends[entry_2])
+
+        if start <= end:
+            common += end - start + 1
+            if not hits_1 or hits_1[-1] != entry_1:
+                hits_1.append(entry_1)
+            if not hits_2 or hits_2[-1] != entry_2:
+                hits_2.append(entry_2)
+
+        if ends[entry_1] < ends[entry_2]:
+            k_1 += 1
+        else:
+            k_2 += 1
+
+    if not common:
+        relation: int = 0
+    elif common == size_1 == size_2:
+        relation = 1
+    elif common == size_1:
+        relation = 2
+    elif common == size_2:
+        relation = 3
     else:
+        relation = 4
+    return relation, hits_1, hits_2
+
+
+def group_socket(ip_entries: List[int], port_entries: List[int], ip: RangeColumn, port: RangeColumn) -> str:
+    return ','.join(f"{int2ip(ip.starts[entry])}-{int2ip(ip.ends[entry])}" for entry in ip_entries) + ':' + \
+        ','.join(f"{port.starts[entry]}-{port.ends[entry]}" for entry in port_entries)
+
+
+def detect_conflicts_between_groups(table: RuleTable, i: int, j: int) -> List[Dict[str, Union[int, str]]]:
+    """
+    Conflicts of rules i and j compiled with --coalesce: every dimension is compared as a whole group,
+    giving at most one conflict per protocol, and the sockets list the sub-ranges overlapping the other rule.
+    """
+    conflicts: List[Dict[str, Union[int, str]]] = list()
+    action: int = int(table.actions[i] == table.actions[j])
+
+    src_ip_relation, src_ip_1, src_ip_2 = relation_between_groups(table.src_ip, table.src_ip.span(i),
+                                                                  table.src_ip.span(j))
+    if not src_ip_relation:
+        return conflicts
+    dst_ip_relation, dst_ip_1, dst_ip_2 = relation_between_groups(table.dst_ip, table.dst_ip.span(i),
+                                                                  table.dst_ip.span(j))
+    if not dst_ip_relation:
+        return conflicts
+    relation_ip: int = RELATION_OF_RELATIONS[dst_ip_relation][src_ip_relation]
+
+    # the dst_port ranges of a coalesced group are sorted by protocol
+    protocols: array = table.protocols
+    by_protocol: Dict[int, List[int]] = dict()
+    for entry in table.dst_port.span(j):
+        by_protocol.setdefault(protocols[entry], list()).append(entry)
+
+    entries_1: Dict[int, List[int]] = dict()
+    for entry in table.dst_port.span(i):
+        entries_1.setdefault(protocols[entry], list()).append(entry)
+
+    for protocol, dst_port_entries in entries_1.items():
+        if protocol not in by_protocol:
+            continue
+
+        dst_port_relation, dst_port_1, dst_port_2 = relation_between_groups(
+            table.dst_port, dst_port_entries, by_protocol[protocol])
+        if not dst_port_relation:
+            continue
+
+        relation: int = RELATION_OF_RELATIONS[relation_ip][dst_port_relation]
+        name: str = CONFLICT_OF_RELATION[action][relation]
+        if not name:
+            continue
+
+        conflict: Dict[str, Union[int, str]] = action_relation_pack(
+            src_ip_relation, dst_ip_relation, 1, dst_port_relation, relation, action, name)
+
+        conflict['pre'] = table.pids[i]
+        conflict['sub'] = table.pids[j]
+        conflict['pre_src_socket'] = group_socket(src_ip_1, list(table.src_port.span(i)), table.src_ip, table.src_port)
+        conflict['pre_dst_socket'] = group_socket(dst_ip_1, dst_port_1, table.dst_ip, table.dst_port)
+        conflict['sub_src_socket'] = group_socket(src_ip_2, list(table.src_port.span(j)), table.src_ip, table.src_port)
+        conflict['sub_dst_socket'] = group_socket(dst_ip_2, dst_port_2, table.dst_ip, table.dst_port)
+        conflict['protocol'] = f"pre: {table.protocol_names[protocol]}, sub: {table.protocol_names[protocol]}"
+        conflict['action'] = f"pre: {table.action_name(i)}, sub: {table.action_name(j)}"
+        conflicts.append(conflict)
 
-        # return len(list(product(socket_1['src_ip'], socket_2['src_ip']))) + \
-        #        len(list(product(socket_1['src_port'], socket_2['src_port']))) + \
-        #        len(list(product(socket_1['dst_ip'], socket_2['dst_ip']))) + \
-        #        len(list(product(socket_1['dst_port'], socket_2['dst_port'])))
-
-        for src_ip_1, src_ip_2 in product(socket_1['src_ip'], socket_2['src_ip']):
-            for src_port_1, src_port_2 in product(socket_1['src_port'], socket_2['src_port']):
-                for dst_ip_1, dst_ip_2 in product(socket_1['dst_ip'], socket_2['dst_ip']):
-                    for dst_port_1, dst_port_2 in product(socket_1['dst_port'], socket_2['dst_port']):
-                        p1 = Policy(pid=policy_1[config.id], protocol=dst_port_1['protocol'],
-                                    src_ip=decimalize(src_ip_1), src_port=src_port_1,
-                                    dst_ip=decimalize(dst_ip_1), dst_port=dst_port_1,
-                                    inactive=policy_1[config.inactive], action=policy_1[config.action]
-                                    )
-                        p2 = Policy(pid=policy_2[config.id], protocol=dst_port_2['protocol'],
-                                    src_ip=decimalize(src_ip_2), src_port=src_port_2,
-                                    dst_ip=decimalize(dst_ip_2), dst_port=dst_port_2,
-                                    inactive=policy_2[config.inactive], action=policy_2[config.action]
-                                    )
-                        conflict: Dict[str, Union[int, str]] = _detect_conflict_between_pure_(p1, p2)
-                        conflict['pre'] = p1.pid
-                        conflict['sub'] = p2.pid
-                        print(conflict)
-
-                        if conflict['conflict']:
-                            conflict[
-                                'pre_src_socket'] = f"{src_ip_1['start']}-{src_ip_1['end']}:{src_port_1['start']}-{src_port_1['end']}"
-                            conflict[
-                                'pre_dst_socket'] = f"{dst_ip_1['start']}-{dst_ip_1['end']}:{dst_port_1['start']}-{dst_port_1['end']}"
-                            conflict[
-                                'sub_src_socket'] = f"{src_ip_2['start']}-{src_ip_2['end']}:{src_port_2['start']}-{src_port_2['end']}"
-                            conflict[
-                                'sub_dst_socket'] = f"{dst_ip_2['start']}-{dst_ip_2['end']}:{dst_port_2['start']}-{dst_port_2['end']}"
-                            conflict['protocol'] = f"pre: {p1.protocol}, sub: {p2.protocol}"
-                            conflict['action'] = f"pre: {policy_1[config.action]}, sub: {policy_2[config.action]}"
-
-                            conflicts.append(conflict)
     return conflicts
 
 
+class NumpyEngine:
+    """
+    Classifies rule i against all of its subsequent rules with array comparisons.
+    Every rule is expanded into the product of its groups (atoms), one atom of rule i being
+    compared with the atoms of the subsequent rules in blocks of `block` atoms.
+    """
+
+    def __init__(self, table: RuleTable, block: int = 1 << 16, pack: Callable[..., Union[Dict, bytes]] = socket_pack):
+        self.table: RuleTable = table
+        self.block: int = block
+        self.pack: Callable[..., Union[Dict, bytes]] = pack
+
+        def _column_(column: RangeColumn) -> Tuple['np.ndarray', 'np.ndarray']:
+            return np.frombuffer(column.starts, dtype=np.int64), np.frombuffer(column.ends, dtype=np.int64)
+
+        self.src_ip = _column_(table.src_ip)
+        self.dst_ip = _column_(table.dst_ip)
+        self.dst_port = _column_(table.dst_port)
+        self.protocols: np.ndarray = np.frombuffer(table.protocols, dtype=np.int64)
+        self.actions: np.ndarray = np.frombuffer(bytes(table.actions), dtype=np.uint8)
+
+        atoms: List[List[int]] = [list() for _ in range(5)]
+        atom_offsets: List[int] = [0]
+        for rule in range(len(table)):
+            for entries in product(table.src_ip.span(rule), table.src_port.span(rule),
+                                   table.dst_ip.span(rule), table.dst_port.span(rule)):
+                atoms[0].append(rule)
+                for k, entry in enumerate(entries):
+                    atoms[k + 1].append(entry)
+            atom_offsets.append(len(atoms[0]))
+        self.atom_offsets: np.ndarray = np.array(atom_offsets, dtype=np.int64)
+
+        self.atom_rule, self.atom_src_ip, self.atom_src_port, self.atom_dst_ip, self.atom_dst_port = \
+            [np.array(atom, dtype=np.int64) for atom in atoms]
+
+        self.relation_table: np.ndarray = np.array(RELATION_OF_RELATIONS, dtype=np.int64)
+        self.conflict_names: List[str] = ['', 'redundant', 'shadowed', 'general', 'correlated']
+        self.conflict_table: np.ndarray = np.array(
+            [[self.conflict_names.index(name) for name in names] for names in CONFLICT_OF_RELATION], dtype=np.int64)
+
+    @staticmethod
+    def find_relation_between_ranges(start_1: int, end_1: int, starts: 'np.ndarray', ends: 'np.ndarray') -> 'np.ndarray':
+        # the same decisions as find_relation_between_ranges, rule 1 being fixed
+        relation: np.ndarray = np.where(
+            start_1 < starts, np.where(end_1 >= ends, 3, 4),
+            np.where(start_1 > starts, np.where(end_1 > ends, 4, 2),
+                     np.where(end_1 < ends, 2, np.where(end_1 == ends, 1, 3))))
+        relation[(end_1 < starts) | (ends < start_1)] = 0
+        return relation
+
+    def subsequent_atoms(self, i: int, subsequent: Optional[List[int]]) -> 'np.ndarray':
+        if subsequent is None:
+            return np.arange(self.atom_offsets[i + 1], self.atom_offsets[-1], dtype=np.int64)
+
+        rules: np.ndarray = np.asarray(subsequent, dtype=np.int64)
+        starts: np.ndarray = self.atom_offsets[rules]
+        counts: np.ndarray = self.atom_offsets[rules + 1] - starts
+        return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum(), dtype=np.int64)
+
+    def collect(self, i: int, subsequent: Optional[List[int]] = None,
+                write: Optional[Callable[[List], None]] = None) -> List[Dict[str, Union[int, str]]]:
+        """
+        The conflicts of rule i with its subsequent rules, or with `write` those of every block passed to it
+        as soon as the block is done, an empty list being returned.
+        """
+        atoms_2: np.ndarray = self.subsequent_atoms(i, subsequent)
+        hits: List[Tuple['np.ndarray', ...]] = list()
+
+        for lo in range(0, atoms_2.size, self.block):
+            block: np.ndarray = atoms_2[lo:lo + self.block]
+            rule_2: np.ndarray = self.atom_rule[block]
+            src_ip_2: np.ndarray = self.atom_src_ip[block]
+            dst_ip_2: np.ndarray = self.atom_dst_ip[block]
+            dst_port_2: np.ndarray = self.atom_dst_port[block]
+
+            action: np.ndarray = (self.actions[rule_2] == self.actions[i]).astype(np.int64)
+            src_ip_bounds = self.src_ip[0][src_ip_2], self.src_ip[1][src_ip_2]
+            dst_ip_bounds = self.dst_ip[0][dst_ip_2], self.dst_ip[1][dst_ip_2]
+            dst_port_bounds = self.dst_port[0][dst_port_2], self.dst_port[1][dst_port_2]
+            protocols: np.ndarray = self.protocols[dst_port_2]
+
+            relations: Dict[Tuple[str, int], np.ndarray] = dict()
+
+            def _relation_(name: str, entry: int, column, bounds) -> np.ndarray:
+                if (name, entry) not in relations:
+                    relations[(name, entry)] = self.find_relation_between_ranges(
+                        column[0][entry], column[1][entry], *bounds)
+                return relations[(name, entry)]
+
+            for atom in range(self.atom_offsets[i], self.atom_offsets[i + 1]):
+                src_ip_1, dst_ip_1, dst_port_1 = \
+                    self.atom_src_ip[atom], self.atom_dst_ip[atom], self.atom_dst_port[atom]
+
+                src_ip_relation: np.ndarray = _relation_('src_ip', src_ip_1, self.src_ip, src_ip_bounds)
+                dst_ip_relation: np.ndarray = _relation_('dst_ip', dst_ip_1, self.dst_ip, dst_ip_bounds)
+                dst_port_relation: np.ndarray = _relation_('dst_port', dst_port_1, self.dst_port, dst_port_bounds)
+
+                index: np.ndarray = np.nonzero(
+                    (src_ip_relation != 0) & (dst_ip_relation != 0) & (dst_port_relation != 0) &
+                    (protocols == self.protocols[dst_port_1]))[0]
+                if not index.size:
+                    continue
+
+                relation: np.ndarray = self.relation_table[
+                    self.relation_table[dst_ip_relation[index], src_ip_relation[index]], dst_port_relation[index]]
+                conflict: np.ndarray = self.conflict_table[action[index], relation]
+
+                keep: np.ndarray = conflict != 0
+                index = index[keep]
+                hits.append((np.full(index.size, atom, dtype=np.int64), block[index],
+                             src_ip_relation[index], dst_ip_relation[index], dst_port_relation[index],
+                             relation[keep], action[index], conflict[keep]))
+
+            if write is not None and hits:
+                write(self.pack_hits(i, hits))
+                hits = list()
+
+        return self.pack_hits(i, hits) if hits else list()
+
+    def pack_hits(self, i: int, hits: List[Tuple['np.ndarray', ...]]) -> List[Dict[str, Union[int, str]]]:
+        table: RuleTable = self.table
+        atom_1, atom_2, src_ip_relation, dst_ip_relation, dst_port_relation, relation, action, conflict = \
+            [np.concatenate(column) for column in zip(*hits)]
+
+        # the order of the nested group loops of detect_conflicts_between_policies
+        order: np.ndarray = np.lexsort((
+            self.atom_dst_port[atom_2], self.atom_dst_port[atom_1],
+            self.atom_dst_ip[atom_2], self.atom_dst_ip[atom_1],
+            self.atom_src_port[atom_2], self.atom_src_port[atom_1],
+            self.atom_src_ip[atom_2], self.atom_src_ip[atom_1],
+            self.atom_rule[atom_2]))
+
+        conflicts: List[Dict[str, Union[int, str]]] = list()
+        for k in order.tolist():
+            a1, a2 = int(atom_1[k]), int(atom_2[k])
+            pack: Dict[str, Union[int, str]] = action_relation_pack(
+                int(src_ip_relation[k]), int(dst_ip_relation[k]), 1, int(dst_port_relation[k]),
+                int(relation[k]), int(action[k]), self.conflict_names[conflict[k]])
+            entries: Tuple[int, ...] = (
+                int(self.atom_src_ip[a1]), int(self.atom_src_ip[a2]),
+                int(self.atom_src_port[a1]), int(self.atom_src_port[a2]),
+                int(self.atom_dst_ip[a1]), int(self.atom_dst_ip[a2]),
+                int(self.atom_dst_port[a1]), int(self.atom_dst_port[a2]))
+            conflicts.append(self.pack(table, i, int(self.atom_rule[a2]), entries, pack))
+
+        return conflicts
+
+
+class IntervalTree:
+    """
+    Static interval tree: the intervals are sorted by start and addressed as an implicit balanced
+    binary tree, every node keeping the largest end of its subtree.
+    With numpy the overlapping intervals are instead selected by one comparison over those starting early enough.
+    """
+
+    __slots__ = ['starts', 'ends', 'keys', 'max_ends', 'sorted_ends', 'np_ends', 'np_keys']
+
+    def __init__(self, intervals: Iterable[Tuple[int, int, int]]):
+        items: List[Tuple[int, int, int]] = sorted(intervals)
+
+        self.starts: array = array('q', (item[0] for item in items))
+        self.ends: array = array('q', (item[1] for item in items))
+        self.keys: array = array('q', (item[2] for item in items))
+        self.max_ends: array = array('q', self.ends)
+
+        def _build_(lo: int, hi: int) -> int:
+            if lo >= hi:
+                return -1
+            mid: int = (lo + hi) // 2
+            self.max_ends[mid] = max(self.ends[mid], _build_(lo, mid), _build_(mid + 1, hi))
+            return self.max_ends[mid]
+
+        _build_(0, len(items))
+        self.sorted_ends: array = array('q', sorted(self.ends))
+
+        if np is not None:
+            self.np_ends = np.frombuffer(self.ends, dtype=np.int64)
+            self.np_keys = np.frombuffer(self.keys, dtype=np.int64)
+
+    def count(self, start: int, end: int) -> int:
+        # intervals starting before `end`, less those ending before `start`
+        return bisect_right(self.starts, end) - bisect_left(self.sorted_ends, start)
+
+    def overlap(self, start: int, end: int) -> List[int]:
+        if np is not None:
+            hi: int = bisect_right(self.starts, end)
+            return self.np_keys[:hi][self.np_ends[:hi] >= start].tolist()
+
+        keys: List[int] = list()
+        stack: List[Tuple[int, int]] = [(0, len(self.starts))]
+
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            mid: int = (lo + hi) // 2
+            if self.max_ends[mid] < start:
+                continue
+            stack.append((lo, mid))
+            if self.starts[mid] <= end:
+                if self.ends[mid] >= start:
+                    keys.append(self.keys[mid])
+                stack.append((mid + 1, hi))
+
+        return keys
+
+
+class CandidateIndex:
+    """
+    Interval trees of the groups on dst_port (one tree per protocol), dst_ip and src_ip.
+    Two rules can only conflict if some groups of them overlap in each of these dimensions, so the
+    candidates of rule i are enumerated from the tree with the fewest overlapping groups and checked
+    against rule i on the other dimensions.
+    """
+
+    def __init__(self, table: RuleTable):
+        self.table: RuleTable = table
+
+        buckets: Dict[int, List[Tuple[int, int, int]]] = dict()
+        for rule in range(len(table)):
+            for entry in table.dst_port.span(rule):
+                buckets.setdefault(table.protocols[entry], list()).append(
+                    (table.dst_port.starts[entry], table.dst_port.ends[entry], rule))
+        self.dst_port: Dict[int, IntervalTree] = {
+            protocol: IntervalTree(intervals) for protocol, intervals in buckets.items()}
+
+        self.dst_ip: IntervalTree = self.build_tree(table.dst_ip)
+        self.src_ip: IntervalTree = self.build_tree(table.src_ip)
+
+    def build_tree(self, column: RangeColumn) -> IntervalTree:
+        return IntervalTree((column.starts[entry], column.ends[entry], rule)
+                            for rule in range(len(self.table)) for entry in column.span(rule))
+
+    def trees(self, dimension: str, entry: int, wildcard: bool = False) -> List[IntervalTree]:
+        if dimension != 'dst_port':
+            return [getattr(self, dimension)]
+        protocol: int = self.table.protocols[entry]
+        if wildcard:
+            return [tree for other, tree in self.dst_port.items() if protocols_meet(self.table, protocol, other)]
+        return [self.dst_port[protocol]] if protocol in self.dst_port else list()
+
+    def rules_overlap(self, dimension: str, i: int, j: int, wildcard: bool = False) -> bool:
+        column: RangeColumn = getattr(self.table, dimension)
+        protocols: array = self.table.protocols
+
+        for entry_1 in column.span(i):
+            for entry_2 in column.span(j):
+                if column.starts[entry_1] <= column.ends[entry_2] and column.starts[entry_2] <= column.ends[entry_1] \
+                        and (dimension != 'dst_port' or protocols[entry_1] == protocols[entry_2]
+                             or wildcard and protocols_meet(self.table, protocols[entry_1], protocols[entry_2])):
+                    return True
+        return False
+
+    def overlapping(self, i: int, keep: Callable[[int], bool], wildcard: bool = False) -> List[int]:
+        """
+        The rules overlapping rule i and kept by `keep`. Rules of different protocols never conflict, but with
+        `wildcard` the rules of protocol any overlap the rules of every protocol, as they do on the packets.
+        """
+        dimensions: List[str] = ['dst_port', 'dst_ip', 'src_ip']
+        counts: List[int] = list()
+
+        for dimension in dimensions:
+            column: RangeColumn = getattr(self.table, dimension)
+            count: int = 0
+            for entry in column.span(i):
+                for tree in self.trees(dimension, entry, wildcard):
+                    count += tree.count(column.starts[entry], column.ends[entry])
+            counts.append(count)
+
+        # rules of the most selective dimension, intersected with those of the next one when it is about as
+        # selective (enumerated at the speed of the tree), and checked against rule i on the remaining ones
+        order: List[int] = sorted(range(len(dimensions)), key=counts.__getitem__)
+        rules: List[int] = [rule for rule in self.enumerate(dimensions[order[0]], i, wildcard) if keep(rule)]
+        checked: List[str] = [dimensions[order[1]], dimensions[order[2]]]
+        if len(rules) > 1 and counts[order[1]] <= 4 * len(rules):
+            rules = list(set(rules).intersection(self.enumerate(checked.pop(0), i, wildcard)))
+        for dimension in checked:
+            rules = [rule for rule in rules if self.rules_overlap(dimension, i, rule, wildcard)]
+        return sorted(set(rules))
+
+    def enumerate(self, dimension: str, i: int, wildcard: bool = False) -> List[int]:
+        column: RangeColumn = getattr(self.table, dimension)
+        rules: List[int] = list()
+        for entry in column.span(i):
+            for tree in self.trees(dimension, entry, wildcard):
+                rules += tree.overlap(column.starts[entry], column.ends[entry])
+        return rules
+
+    def candidates(self, i: int) -> List[int]:
+        return self.overlapping(i, lambda rule: rule > i)
+
+    def select(self, scope: Dict[str, Union[str, tuple]]) -> List[int]:
+        """The rules overlapping every filter of `scope` (see parse_scope), rules of any protocol matching them all."""
+        selected: List[set] = list()
+
+        def _rules_(tree: IntervalTree, ranges: Iterable[tuple]) -> set:
+            return {rule for bounds in ranges for rule in tree.overlap(bounds[0], bounds[1])}
+
+        for dimension in ['src_ip', 'dst_ip']:
+            if dimension in scope:
+                selected.append(_rules_(getattr(self, dimension), scope[dimension]))
+        if 'ip' in scope:
+            selected.append(_rules_(self.src_ip, scope['ip']) | _rules_(self.dst_ip, scope['ip']))
+
+        if 'dst_port' in scope or 'protocol' in scope:
+            ports: Dict[str, List[tuple]] = dict()
+            for start, end, protocol in scope.get('dst_port', ((0, 65535, ''), )):
+                ports.setdefault((protocol or scope.get('protocol', 'any')).lower(), list()).append((start, end))
+
+            rules: set = set()
+            for code, tree in self.dst_port.items():
+                name: str = self.table.protocol_names[code].lower()
+                for protocol, ranges in ports.items():
+                    if protocol == 'any' or name in [protocol, 'any']:
+                        rules |= _rules_(tree, ranges)
+            selected.append(rules)
+
+        return sorted(set.intersection(*selected))
+
+
+class Detector:
+    """
+    Collects the conflicts between rule i and its subsequent rules with the configured engine,
+    restricting the subsequent rules to the candidates of the index when pruning.
+    """
+
+    def __init__(self, table: RuleTable, config):
+        self.table: RuleTable = table
+        self.pairs: int = 0
+        self.combinations: int = 0
+
+        # group combinations of every rule, and their prefix sums
+        self.atoms: array = array('q', (
+            len(table.src_ip.span(rule)) * len(table.src_port.span(rule)) *
+            len(table.dst_ip.span(rule)) * len(table.dst_port.span(rule)) for rule in range(len(table))))
+        self.atom_prefix: array = array('q', [0])
+        for atoms in self.atoms:
+            self.atom_prefix.append(self.atom_prefix[-1] + atoms)
+
+        self.trace_rate: float = config.trace_rate if config.trace else 0.0
+        self.traces: List[Dict] = list()
+
+        # the conflicts are records of record_pack instead of dicts with --memory
+        self.records: bool = bool(config.memory)
+        pack: Callable[..., Union[Dict, bytes]] = record_pack if self.records else socket_pack
+
+        if config.coalesce:
+            # whole groups are compared by detect_conflicts_between_groups, whatever the engine
+            self.engine: Callable[..., List[Dict[str, Union[int, str]]]] = partial(collect_partial_conflicts, table, detect=detect_conflicts_between_groups)
+        elif config.engine == 'numpy' or (config.engine == 'auto' and np is not None):
+            if np is None:
+                raise ImportError('numpy is required by --engine=numpy')
+            self.engine = NumpyEngine(table, pack=pack).collect
+        else:
+            self.engine = partial(collect_partial_conflicts, table,
+                                  detect=partial(detect_conflicts_between_policies, pack=pack))
+
+        self.index: Optional[CandidateIndex] = CandidateIndex(table) if config.prune else None
+
+    def sampled(self, i: int) -> bool:
+        # the same rules are sampled whatever the worker handling them
+        return self.trace_rate > 0 and (i * 2654435761) & 0xffffffff < self.trace_rate * (1 << 32)
+
+    def collect(self, i: int, write: Optional[Callable[[List], None]] = None) -> List[Dict[str, Union[int, str]]]:
+        """
+        The conflicts of rule i with its subsequent rules. With `write`, they are passed to it in parts as the engine
+        finds them and an empty list is returned, so that --memory spills the records of a rule with many conflicts
+        before all of them are found.
+        """
+        start: float = perf_counter()
+
+        # the number and the first of the conflicts passed to write, for the trace
+        written: List[Union[Dict[str, Union[int, str]], bytes]] = list()
+        count: int = 0
+
+        def _write_(conflicts: List):
+            nonlocal count
+            count += len(conflicts)
+            written.extend(conflicts[:8 - len(written)])
+            write(conflicts)
+
+        emit: Optional[Callable[[List], None]] = None if write is None else _write_
+        if self.index is None:
+            self.pairs += len(self.table) - 1 - i
+            self.combinations += self.atoms[i] * (self.atom_prefix[-1] - self.atom_prefix[i + 1])
+            conflicts: List[Dict[str, Union[int, str]]] = self.engine(i, write=emit)
+            subsequent: int = len(self.table) - 1 - i
+        else:
+            candidates: List[int] = self.index.candidates(i)
+            conflicts = self.collect_among(i, candidates, emit)
+            subsequent = len(candidates)
+
+        if self.sampled(i):
+            sample: List = conflicts[:8] if write is None else written
+            self.traces.append({'pre': self.table.pids[i], 'rule': i, 'subsequent': subsequent,
+                                'conflicts': len(conflicts) if write is None else count,
+                                'seconds': perf_counter() - start,
+                                'sample': [render_record(self.table, conflict) for conflict in sample]
+                                if self.records else sample})
+        return conflicts
+
+    def subsequent(self, i: int) -> List[int]:
+        if self.index is None:
+            return list(range(i + 1, len(self.table)))
+        return self.index.candidates(i)
+
+    def collect_among(self, i: int, subsequent: List[int],
+                      write: Optional[Callable[[List], None]] = None) -> List[Dict[str, Union[int, str]]]:
+        self.pairs += len(subsequent)
+        for j in subsequent:
+            self.combinations += self.atoms[i] * self.atoms[j]
+        return self.engine(i, subsequent, write=write) if subsequent else list()
+
+    def drain(self) -> Tuple[Counter, List[Dict]]:
+        counters: Counter = Counter(pairs=self.pairs, combinations=self.combinations)
+        traces: List[Dict] = self.traces
+        self.pairs, self.combinations, self.traces = 0, 0, list()
+        return counters, traces
+
+    def preceding(self, j: int, keep: Callable[[int], bool]) -> List[int]:
+        # the rules before j which may conflict with it
+        if self.index is None:
+            return [i for i in range(j) if keep(i)]
+        return self.index.overlapping(j, lambda rule: rule < j and keep(rule))
+
+
+Box = Tuple[int, int, int, int, int, int, int, int]
+
+
+def boxes_intersect(box_1: Box, box_2: Box) -> bool:
+    return box_1[0] <= box_2[1] and box_2[0] <= box_1[1] and box_1[2] <= box_2[3] and box_2[2] <= box_1[3] \
+        and box_1[4] <= box_2[5] and box_2[4] <= box_1[5] and box_1[6] <= box_2[7] and box_2[6] <= box_1[7]
+
+
+def subtract_box(box: Box, cut: Box) -> List[Box]:
+    """Disjoint pieces of `box` outside `cut`, at most two per dimension."""
+    pieces: List[Box] = list()
+    bounds: List[int] = list(box)
+
+    for d in range(0, len(box), 2):
+        if bounds[d] < cut[d]:
+            pieces.append(tuple(bounds[:d] + [bounds[d], cut[d] - 1] + bounds[d + 2:]))
+            bounds[d] = cut[d]
+        if bounds[d + 1] > cut[d + 1]:
+            pieces.append(tuple(bounds[:d] + [cut[d + 1] + 1, bounds[d + 1]] + bounds[d + 2:]))
+            bounds[d + 1] = cut[d + 1]
+    return pieces
+
+
+def merge_boxes(boxes: List[Box]) -> List[Box]:
+    """Merge disjoint boxes which are adjacent along one dimension and equal along the others, until none is left."""
+    merged: bool = True
+    while merged and len(boxes) > 1:
+        merged = False
+        for d in range(0, len(boxes[0]), 2):
+            boxes.sort(key=lambda box: box[:d] + box[d + 2:] + box[d:d + 2])
+            result: List[Box] = [boxes[0]]
+            for box in boxes[1:]:
+                last: Box = result[-1]
+                if last[:d] == box[:d] and last[d + 2:] == box[d + 2:] and last[d + 1] + 1 == box[d]:
+                    result[-1] = last[:d + 1] + (box[d + 1], ) + last[d + 2:]
+                    merged = True
+                else:
+                    result.append(box)
+            boxes = result
+    return boxes
+
+
+class ResidualSpace:
+    """
+    Packets of a rule not matched by the earlier rules yet, kept per protocol as disjoint boxes
+    (src_ip, src_port, dst_ip, dst_port) from which the boxes of the earlier rules are subtracted in order.
+    The boxes of protocol any are kept under every protocol of the table, and under any for the other protocols,
+    so that the rules of protocol any cut the packets of every protocol, as in replay.Classifier.
+    Once a subtraction splits the space beyond `cap` boxes, even after merging, the space stops being exact
+    and is considered reachable: the dead rules found are still dead, some may be missed.
+    """
+
+    def __init__(self, table: RuleTable, rule: int, cap: int):
+        self.table: RuleTable = table
+        self.cap: int = cap
+        self.capped: bool = False
+        self.names: List[str] = [name.lower() for name in table.protocol_names]
+
+        self.space: Dict[str, List[Box]] = self.boxes(rule)
+        if 'any' in self.space:
+            for protocol in set(self.names) - {'any'}:
+                self.space[protocol] = self.space.get(protocol, list()) + self.space['any']
+
+    def boxes(self, rule: int) -> Dict[str, List[Box]]:
+        table: RuleTable = self.table
+        boxes: Dict[str, List[Box]] = dict()
+        for src_ip, src_port, dst_ip, dst_port in product(table.src_ip.span(rule), table.src_port.span(rule),
+                                                          table.dst_ip.span(rule), table.dst_port.span(rule)):
+            boxes.setdefault(self.names[table.protocols[dst_port]], list()).append((
+                table.src_ip.starts[src_ip], table.src_ip.ends[src_ip],
+                table.src_port.starts[src_port], table.src_port.ends[src_port],
+                table.dst_ip.starts[dst_ip], table.dst_ip.ends[dst_ip],
+                table.dst_port.starts[dst_port], table.dst_port.ends[dst_port]))
+        return boxes
+
+    def cuts(self, rule: int) -> Iterator[Tuple[str, List[Box]]]:
+        # the boxes of `rule` cutting the space of every protocol, those of protocol any cutting all of them
+        boxes: Dict[str, List[Box]] = self.boxes(rule)
+        for protocol in self.space:
+            cuts: List[Box] = boxes.get(protocol, list()) + (boxes.get('any', list()) if protocol != 'any' else list())
+            if cuts:
+                yield protocol, cuts
+
+    def empty(self) -> bool:
+        return not any(self.space.values())
+
+    def reachable(self, rule: int) -> bool:
+        for protocol, cuts in self.cuts(rule):
+            for box in self.space[protocol]:
+                if any(boxes_intersect(box, cut) for cut in cuts):
+                    return True
+        return False
+
+    def subtract(self, rule: int) -> bool:
+        """Remove the boxes of `rule`, return False if the space went beyond the cap."""
+        for protocol, cuts in list(self.cuts(rule)):
+            space: List[Box] = self.space[protocol]
+            for cut in cuts:
+                space = [piece for box in space for piece in (subtract_box(box, cut) if boxes_intersect(box, cut)
+                                                              else [box])]
+            if len(space) > len(self.space[protocol]):
+                space = merge_boxes(space)
+            if len(space) > self.cap:
+                self.capped = True
+                return False
+            self.space[protocol] = space
+        return True
+
+
+def residual_space(table: RuleTable, rule: int, earlier: Iterable[int], cap: int) -> Tuple[ResidualSpace, List[int]]:
+    """The space of `rule` left by the `earlier` rules (in order), and the earlier rules deciding some of its packets."""
+    space: ResidualSpace = ResidualSpace(table, rule, cap)
+    deciding: List[int] = list()
+
+    for other in earlier:
+        if not space.reachable(other):
+            continue
+        deciding.append(other)
+        if not space.subtract(other) or space.empty():
+            break
+    return space, deciding
+
+
+def dead_rule(table: RuleTable, rule: int, deciding: List[int], cap: int) -> Dict[str, Union[str, List[str]]]:
+    single: Optional[int] = None
+    for other in deciding:
+        alone: ResidualSpace = ResidualSpace(table, rule, cap)
+        if alone.subtract(other) and alone.empty():
+            single = other
+            break
+
+    same: bool = table.actions[single] == table.actions[rule] if single is not None else \
+        all(table.actions[other] == table.actions[rule] for other in deciding)
+    return {'rule': table.pids[rule], 'conflict': 'redundant' if same else 'shadowed',
+            'deciding': [table.pids[other] for other in deciding],
+            'single': table.pids[single] if single is not None else ''}
+
+
+def find_dead_rules(table: RuleTable, config, stats: Optional[Stats] = None,
+                    rules: Optional[List[int]] = None) -> List[Dict[str, Union[str, List[str]]]]:
+    """
+    Rules never matched in first-match order because the union of the earlier rules covers them, even if none
+    of these rules covers them alone. The space of every rule is reduced by the earlier rules overlapping it
+    (found by the CandidateIndex) until nothing is left. Only `rules` are checked if given.
+    `deciding` lists the earlier rules matching some packets of a dead rule first, and `single` the earlier rule
+    covering it alone (the pairwise view), if any. A dead rule is redundant if `single` has its action, or else
+    if all the deciding rules have it, shadowed otherwise.
+    """
+    stats = stats or Stats()
+
+    with stats.stage('index'):
+        index: CandidateIndex = CandidateIndex(table)
+
+    dead: List[Dict[str, Union[str, List[str]]]] = list()
+    capped: int = 0
+
+    with stats.stage('residual'):
+        for rule in tqdm(range(len(table)) if rules is None else rules):
+            space, deciding = residual_space(table, rule, index.overlapping(rule, lambda earlier: earlier < rule,
+                                                                            wildcard=True), config.box_cap)
+            capped += space.capped
+
+            if space.empty():
+                dead.append(dead_rule(table, rule, deciding, config.box_cap))
+
+    stats.counters['dead_rules'] += len(dead)
+    stats.counters['dead_rules_single'] += builtins.sum(1 for rule in dead if rule['single'])
+    stats.counters['residual_capped'] += capped
+    print(f"dead rules: {len(dead)}, covered by a single rule: {stats.counters['dead_rules_single']}, "
+          f"rules beyond the box cap: {capped}")
+    return dead
+
+
 def check_overauthorization(policy: List[str], config) -> bool:
     src_ip = policy[config.src_ip].lower() in ['any', '0.0.0.0', '*.*.*.*']
     dst_ip = policy[config.dst_ip].lower() in ['any', '0.0.0.0', '*.*.*.*']
@@ -368,22 +1424,508 @@ def check_overauthorization(policy: List[str], config) -> bool:
         return src_ip or dst_ip or dst_port
 
 
-def detect_partial_conflicts(policy_1: List[str], subsequent_policy_list: List[List[str]], config):
-    conflicts: List[Dict[str, int]] = list()
+def collect_partial_conflicts(table: RuleTable, i: int, subsequent: Optional[List[int]] = None,
+                              detect: Callable[[RuleTable, int, int], List[Dict[str, Union[int, str]]]]
+                              = detect_conflicts_between_policies,
+                              write: Optional[Callable[[List], None]] = None) -> List[Dict[str, Union[int, str]]]:
+    # with `write`, the conflicts of every pair are passed to it instead of being returned
+    conflicts: List[Dict[str, Union[int, str]]] = list()
+
+    for j in (range(i + 1, len(table)) if subsequent is None else subsequent):
+        if write is None:
+            conflicts += detect(table, i, j)
+            continue
+        found: List[Dict[str, Union[int, str]]] = detect(table, i, j)
+        if found:
+            write(found)
+
+    return conflicts
 
-    for policy_2 in subsequent_policy_list:
-        conflicts += detect_conflicts_between_policies(policy_1, policy_2, config)
 
+def write_partial_conflicts(table: RuleTable, i: int, conflicts: List[Dict[str, Union[int, str]]], config):
     if len(conflicts):
-        with open(os.path.join(config.cdir, f'{policy_1[config.id]}.json'), 'w+') as f:
+        with open(os.path.join(config.cdir, f'{table.pids[i]}.json'), 'w+') as f:
             json.dump(conflicts, f)
 
 
-def main(config):
-    # process_pool = Pool(config.workers)
+class DirectorySink:
+    """Writes the conflicts of every rule into `<cdir>/<id>.json`."""
+
+    def __init__(self, config):
+        self.config = config
+
+    def write(self, table: RuleTable, i: int, conflicts: List[Dict[str, Union[int, str]]]):
+        write_partial_conflicts(table, i, conflicts, self.config)
+
+    def close(self):
+        pass
+
+
+class StreamSink:
+    """
+    Appends the conflicts to a single JSON Lines file (gzip if the name ends with .gz),
+    holding at most `buffer` lines before writing them out.
+    """
+
+    def __init__(self, path: str, buffer: int):
+        self.file: TextIO = gzip.open(path, 'at') if path.endswith('.gz') else open(path, 'a')
+        self.buffer: int = max(buffer, 1)
+        self.lines: List[str] = list()
+
+    def write(self, table: RuleTable, i: int, conflicts: List[Dict[str, Union[int, str]]]):
+        for conflict in conflicts:
+            self.lines.append(json.dumps(conflict))
+            if len(self.lines) >= self.buffer:
+                self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.file.write('\n'.join(self.lines) + '\n')
+            self.lines.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class SpillSink:
+    """
+    Holds the records of --memory until they take `config.memory` MB (divided among `shares` processes), then writes
+    them sorted into the next run `<cdir>/conflicts.<pid>.<n>.run`, the workers of --workers spilling runs of their
+    own. On closing, the runs of all the processes are merged down to MERGE_FANIN of them and the table is written
+    into `<cdir>/conflicts.rules` (see dump_table) for the records to be rendered without the csv.
+    """
+
+    def __init__(self, config, table: RuleTable, shares: int = 1):
+        self.directory: str = config.cdir
+        self.table: RuleTable = table
+        # a record costs its bytes object and its slot in the list
+        self.limit: int = max((config.memory << 20) // max(shares, 1) // (RECORD.size + 41), 1)
+        self.records: List[bytes] = list()
+        self.written: int = 0
+
+    def write(self, table: RuleTable, i: int, conflicts: List[bytes]):
+        self.records += conflicts
+        if len(self.records) >= self.limit:
+            self.spill()
+
+    def run_path(self) -> str:
+        self.written += 1
+        return os.path.join(self.directory, f'conflicts.{os.getpid()}.{self.written - 1:06d}.run')
+
+    def spill(self):
+        if not self.records:
+            return
+        self.records.sort()
+        with open(self.run_path(), 'wb') as f:
+            for lo in range(0, len(self.records), 1 << 16):
+                f.write(b''.join(self.records[lo:lo + (1 << 16)]))
+        self.records.clear()
+
+    def close(self):
+        self.spill()
+
+        # merge the oldest runs in groups, so that the readers keep few files open
+        runs: List[str] = glob_runs(self.directory)
+        while len(runs) > MERGE_FANIN:
+            merged, runs = runs[:MERGE_FANIN], runs[MERGE_FANIN:]
+            path: str = self.run_path()
+            with open(path + '.tmp', 'wb') as f:
+                for record in read_runs(merged):
+                    f.write(record)
+            for run in merged:
+                os.remove(run)
+            os.replace(path + '.tmp', path)
+            runs.append(path)
+
+        if runs:
+            dump_table(os.path.join(self.directory, 'conflicts.rules'), self.table, list(), list())
+
+
+MERGE_FANIN: int = 64
+
+
+def glob_runs(directory: str) -> List[str]:
+    from glob import glob
+    return sorted(glob(os.path.join(directory, '*.run')))
+
+
+def run_paths(config) -> List[str]:
+    return glob_runs(config.cdir)
+
+
+def read_run(path: str) -> Iterator[bytes]:
+    size: int = RECORD.size
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, size << 12), b''):
+            for lo in range(0, len(chunk), size):
+                yield chunk[lo:lo + size]
+
+
+def read_runs(paths: List[str]) -> Iterator[bytes]:
+    """The records of the sorted runs, merged in detection order."""
+    return heapq.merge(*(read_run(path) for path in paths))
+
+
+def render_conflicts(config) -> int:
+    """Write the conflicts of the runs under cdir as JSON Lines into cdir/conflicts.jsonl(.gz), return their number."""
+    paths: List[str] = run_paths(config)
+    if not paths:
+        return 0
+
+    table: RuleTable = map_rules(os.path.join(config.cdir, 'conflicts.rules'))
+    sink: StreamSink = StreamSink(stream_path(config), config.buffer)
+    count: int = 0
+    for record in read_runs(paths):
+        sink.write(table, 0, [render_record(table, record)])
+        count += 1
+    sink.close()
+    return count
+
+
+def stream_path(config) -> str:
+    return os.path.join(config.cdir, 'conflicts.jsonl.gz' if config.gzip else 'conflicts.jsonl')
+
+
+def open_sink(config, table: RuleTable) -> Union[DirectorySink, StreamSink, SpillSink]:
+    if config.memory:
+        return SpillSink(config, table)
+    if config.stream:
+        return StreamSink(stream_path(config), config.buffer)
+    return DirectorySink(config)
+
+
+def conflict_paths(config) -> List[str]:
+    from glob import glob
+    paths: List[str] = list()
+    for pattern in ['*.json', '*.jsonl', '*.jsonl.gz']:
+        paths += glob(os.path.join(config.cdir, pattern))
+    return sorted(paths)
+
+
+def read_conflicts(path: str) -> Iterator[Dict[str, Union[int, str]]]:
+    if path.endswith('.json'):
+        with open(path, 'r') as cf:
+            yield from json.load(cf)
+        return
+
+    with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as cf:
+        for line in cf:
+            if line.strip():
+                yield json.loads(line)
+
+
+def split_pair_space(n: int, chunks: int) -> List[Tuple[int, int]]:
+    """
+    Split the rules [0, n-1) into contiguous chunks holding about the same number of pairs,
+    rule i being paired with its n-1-i subsequent rules.
+    """
+    total: int = n * (n - 1) // 2
+    target: float = total / max(chunks, 1)
+
+    bounds: List[Tuple[int, int]] = list()
+    start: int = 0
+    pairs: int = 0
+
+    for i in range(n - 1):
+        pairs += n - 1 - i
+        if pairs >= target * (len(bounds) + 1) or i == n - 2:
+            bounds.append((start, i + 1))
+            start = i + 1
+
+    return bounds
+
+
+_worker_detector_: Optional[Detector] = None
+_worker_sink_: Optional[SpillSink] = None
+
+
+def _init_worker_(table: RuleTable, config):
+    global _worker_detector_, _worker_sink_
+    _worker_detector_ = Detector(table, config)
+    # with --memory the workers spill their own runs, sharing the budget, instead of sending the records back
+    _worker_sink_ = SpillSink(config, table, config.workers) if config.memory else None
+
+
+def _detect_chunk_(bounds: Tuple[int, int]) -> Tuple[List[Tuple[int, List[Dict[str, Union[int, str]]]]],
+                                                    Counter, List[Dict]]:
+    if _worker_sink_ is None:
+        results = [(i, _worker_detector_.collect(i)) for i in range(*bounds)]
+        return (results, ) + _worker_detector_.drain()
+
+    stats: Stats = Stats()
+    for i in range(*bounds):
+        _worker_detector_.collect(i, spill_writer(_worker_sink_, i, stats))
+    # the records of the chunk are on disk before the parent is told it is done
+    _worker_sink_.spill()
+    counters, traces = _worker_detector_.drain()
+    return list(), counters + stats.counters, traces
+
+
+def spill_writer(sink: SpillSink, i: int, stats: Stats) -> Callable[[List[bytes]], None]:
+    """The write of Detector.collect counting the records of rule i and passing them to the spilling sink."""
+
+    def _write_(records: List[bytes]):
+        with stats.stage('write'):
+            stats.count_conflicts(records)
+            sink.write(sink.table, i, records)
+
+    return _write_
+
+
+class TraceSink:
+    """Appends the sampled trace records of the detector to a JSON Lines file, or drops them."""
+
+    def __init__(self, config):
+        self.file: Optional[TextIO] = open(config.trace, 'w') if config.trace else None
+
+    def write(self, traces: List[Dict]):
+        if self.file is not None:
+            for trace in traces:
+                self.file.write(json.dumps(trace) + '\n')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def detect_all_conflicts(table: RuleTable, config, stats: Optional[Stats] = None) -> int:
+    stats = stats or Stats()
+    total: int = len(table) * (len(table) - 1) // 2
+
+    sink: Union[DirectorySink, StreamSink, SpillSink] = open_sink(config, table)
+    trace: TraceSink = TraceSink(config)
+
+    if config.workers <= 1:
+        with stats.stage('index'):
+            detector: Detector = Detector(table, config)
+        for i in trange(len(table) - 1):
+            with stats.stage('detection'):
+                # the records of --memory are spilled as they are found, the others written once the rule is done
+                conflicts: List[Dict[str, Union[int, str]]] = detector.collect(
+                    i, spill_writer(sink, i, stats) if config.memory else None)
+            with stats.stage('write'):
+                stats.count_conflicts(conflicts)
+                sink.write(table, i, conflicts)
+        counters, traces = detector.drain()
+        stats.counters.update(counters)
+        trace.write(traces)
+    else:
+        chunks: List[Tuple[int, int]] = split_pair_space(len(table), config.workers * config.chunks)
+
+        with Pool(config.workers, initializer=_init_worker_, initargs=(table, config)) as pool:
+            results_of_chunks = iter(tqdm(pool.imap(_detect_chunk_, chunks), total=len(chunks)))
+            while True:
+                with stats.stage('detection'):
+                    chunk = next(results_of_chunks, None)
+                if chunk is None:
+                    break
+                results, counters, traces = chunk
+                with stats.stage('write'):
+                    stats.counters.update(counters)
+                    trace.write(traces)
+                    for i, conflicts in results:
+                        stats.count_conflicts(conflicts)
+                        sink.write(table, i, conflicts)
+
+    with stats.stage('write'):
+        sink.close()
+        trace.close()
+
+    pairs: int = stats.counters['pairs']
+    print(f'pairs: {total}, examined: {pairs}, pruned: {total - pairs}')
+    return pairs
+
+
+def detect_scoped(table: RuleTable, config, stats: Optional[Stats] = None) -> List[int]:
+    """
+    Detect the conflicts involving the rules overlapping `config.scope`, i.e. the conflicts of a full run whose
+    pre or sub rule is in the scope, in the same order. Only the rules in the scope and the earlier or later rules
+    overlapping them are examined. Return the rules in the scope.
+    """
+    stats = stats or Stats()
+
+    with stats.stage('index'):
+        scope: Dict[str, Union[str, tuple]] = parse_scope(config.scope)
+        detector: Detector = Detector(table, config)
+        index: CandidateIndex = detector.index or CandidateIndex(table)
+        selected: List[int] = index.select(scope)
+
+    # subsequent rules of every rule, at least one of the pair being in the scope
+    pending: Dict[int, set] = dict()
+    with stats.stage('detection'):
+        chosen: set = set(selected)
+        for rule in selected:
+            pending.setdefault(rule, set()).update(index.candidates(rule))
+            for earlier in index.overlapping(rule, lambda other: other < rule and other not in chosen):
+                pending.setdefault(earlier, set()).add(rule)
+
+    sink: Union[DirectorySink, StreamSink, SpillSink] = open_sink(config, table)
+    for i in tqdm(sorted(pending)):
+        with stats.stage('detection'):
+            conflicts: List[Dict[str, Union[int, str]]] = detector.collect_among(
+                i, sorted(pending[i]), spill_writer(sink, i, stats) if config.memory else None)
+        with stats.stage('write'):
+            stats.count_conflicts(conflicts)
+            sink.write(table, i, conflicts)
+
+    with stats.stage('write'):
+        sink.close()
+    stats.counters.update(detector.drain()[0])
+    stats.counters['rules_in_scope'] += len(selected)
+
+    print(f'rules in scope: {len(selected)}, pairs examined: {stats.counters["pairs"]}')
+    return selected
+
+
+def format_ip_groups(group: tuple) -> str:
+    if group == ((0, 4294967295), ):
+        return 'ANY'
+    return ','.join(int2ip(start) if start == end else f'{int2ip(start)}-{int2ip(end)}' for start, end in group)
+
+
+def format_port_groups(group: tuple, if_prot: bool) -> str:
+    if group in [((0, 65535, 'any'), ), ((0, 65535, ''), )]:
+        return 'ANY'
+    return ','.join((f'{protocol}_' if if_prot else '') + (f'{start}' if start == end else f'{start}-{end}')
+                    for start, end, protocol in group)
+
+
+def falls_through(table: RuleTable, space: ResidualSpace, rule: int, later: Iterable[int]) -> bool:
+    """If the packets left in `space` of `rule` are all matched by `later` rules (in order) of the same action."""
+    for other in later:
+        if not space.reachable(other):
+            continue
+        if table.actions[other] != table.actions[rule] or not space.subtract(other):
+            return False
+        if space.empty():
+            return True
+    return space.empty()
+
+
+def first_match_equivalent(original: List[List[str]], compacted: List[List[str]], config) -> Tuple[bool, int]:
+    """
+    Check geometrically that both rule lists give the same action to every packet: the packets decided by every
+    rule of one list must be decided by rules of the same action in the other list, in both directions.
+    Return the result and the number of rules whose spaces went beyond --box_cap, the result being False then.
+    """
+    table: RuleTable = compile_rules(original + compacted, config)
+    index: CandidateIndex = CandidateIndex(table)
+    offset: int = len(original)
+    capped: int = 0
 
+    for rule in trange(len(table)):
+        lo, hi = (0, offset) if rule < offset else (offset, len(table))
+        overlapping: List[int] = index.overlapping(rule, lambda other: other != rule, wildcard=True)
+
+        space, _ = residual_space(table, rule, (other for other in overlapping if lo <= other < rule), config.box_cap)
+        if space.empty():
+            continue
+        if space.capped:
+            capped += 1
+            continue
+
+        # the same packets in the other list
+        others: List[int] = [other for other in overlapping if not lo <= other < hi]
+        if not falls_through(table, space, rule, others):
+            capped += space.capped
+            return False, capped
+
+    return capped == 0, capped
+
+
+def compact_rules(config, stats: Optional[Stats] = None) -> Dict:
+    """
+    Write into `config.compact` the active rules (overauthorized ones included) without the rules never matched,
+    without the rules whose packets are all matched by later rules of the same action, and with the adjacent
+    rules of the same action differing in one field merged; then check that both lists are first-match equivalent.
+    The details are written into the JSON file next to the csv.
+    """
+    stats = stats or Stats()
+    if_prot: bool = config.protocol < 0
+
+    with stats.stage('load'):
+        policies: List[List[str]] = [policy for policy in read_policies(config) if not policy[config.inactive]]
+    with stats.stage('parse'):
+        table: RuleTable = compile_rules(policies, config)
+    with stats.stage('index'):
+        index: CandidateIndex = CandidateIndex(table)
+
+    removed: Dict[int, Dict[str, Union[str, List[str]]]] = dict()
+    with stats.stage('compaction'):
+        for rule in trange(len(table)):
+            overlapping: List[int] = index.overlapping(rule, lambda other: other != rule and other not in removed,
+                                                       wildcard=True)
+            space, deciding = residual_space(table, rule, (other for other in overlapping if other < rule),
+                                             config.box_cap)
+            if space.empty():
+                removed[rule] = dead_rule(table, rule, deciding, config.box_cap)
+            elif not space.capped and falls_through(table, space, rule, (other for other in overlapping
+                                                                         if other > rule)):
+                removed[rule] = {'rule': table.pids[rule], 'conflict': 'redundant', 'deciding': list(), 'single': ''}
+
+        # adjacent rules of the same action equal in every field but one are replaced by the union
+        fields: List[str] = ['src_ip', 'src_port', 'dst_ip', 'dst_port']
+        kept: List[Tuple[List[str], Dict[str, tuple], List[str]]] = list()
+        for rule in range(len(table)):
+            if rule in removed:
+                continue
+            policy: List[str] = policies[rule]
+            socket: Dict[str, tuple] = {field: coalesce_group(group) for field, group in parse_fields(policy, config).items()}
+
+            if kept:
+                previous, previous_socket, merged = kept[-1]
+                different: List[str] = [field for field in fields if socket[field] != previous_socket[field]]
+                if len(different) == 1 and table.actions[rule] == Policy.boolean_action(previous[config.action]) \
+                        and (if_prot or Policy.transform_protocol(policy[config.protocol]) ==
+                             Policy.transform_protocol(previous[config.protocol])):
+                    field: str = different[0]
+                    previous_socket[field] = coalesce_group(previous_socket[field] + socket[field])
+                    previous = list(previous)
+                    previous[getattr(config, field)] = format_ip_groups(previous_socket[field]) \
+                        if field.endswith('ip') else format_port_groups(previous_socket[field], if_prot)
+                    kept[-1] = (previous, previous_socket, merged + [table.pids[rule]])
+                    continue
+            kept.append((policy, socket, list()))
+
+    compacted: List[List[str]] = [policy for policy, _, _ in kept]
+
+    with stats.stage('verification'):
+        equivalent, capped = first_match_equivalent(policies, compacted, config)
+
+    with stats.stage('write'):
+        with open(config.compact, 'w', newline='') as f:
+            writer = csv.writer(f)
+            if not config.test:
+                with open(config.fpath, 'r', newline='') as source:
+                    writer.writerows(islice(csv.reader(source), config.first_policy))
+            writer.writerows(compacted)
+
+        report: Dict = {
+            'before': len(policies), 'after': len(compacted),
+            'removed': [removed[rule] for rule in sorted(removed)],
+            'merged': {policy[config.id]: merged for policy, _, merged in kept if merged},
+            'equivalent': equivalent, 'capped': capped
+        }
+        with open(os.path.splitext(config.compact)[0] + '.json', 'w') as f:
+            json.dump(report, f, indent=2)
+
+    stats.counters['compact_before'] += len(policies)
+    stats.counters['compact_after'] += len(compacted)
+    print(f"rules before: {len(policies)}, after: {len(compacted)} "
+          f"(removed {len(removed)}, merged {builtins.sum(len(merged) for _, _, merged in kept)}), "
+          f"first-match equivalent: {'yes' if equivalent else 'not proven' if capped else 'no'}")
+    return report
+
+
+def read_csv_policies(config) -> Iterator[List[str]]:
+    with open(config.fpath, 'r', newline='') as csvfile:
+        yield from islice(csv.reader(csvfile), config.first_policy, None)
+
+
+def read_policies(config) -> Iterable[List[str]]:
     if config.test:
-        _reader = [
+        policies: List[List[str]] = [
             ['1', '', '', '', '140.192.37.20', 'ANY', '', '*.*.*.*', '', 'tcp_80', 'deny'],
             ['2', '', '', '', '140.192.37.0-140.192.37.255', 'ANY', '', '*.*.*.*', '', 'tcp_80', 'accept'],
             ['3', '', '', '', '*.*.*.*', 'ANY', '', '140.192.37.40', '', 'tcp_80', 'accept'],
@@ -397,84 +1939,541 @@ def main(config):
             ['11', '', '', '', '*.*.*.*', 'ANY', '', '140.192.37.0-140.192.37.255', '', 'udp_53', 'accept'],
             ['12', '', '', '', '*.*.*.*', 'ANY', '', '*.*.*.*', '', 'udp_0-65535', 'deny'],
         ]
-    else:
-        with open(config.fpath, 'r') as csvfile:
-            _reader = list(csv.reader(csvfile))[config.first_policy:]
+        return policies[config.first_policy:]
 
-    overauthorization: int = 0
-    overauthorized_list: List[str] = list()
+    if config.lazy:
+        return read_csv_policies(config)
+    return list(read_csv_policies(config))
 
-    disable: int = 0
-    disable_list: List[str] = list()
 
-    reader: List[List[str]] = list()
+CACHE_VERSION: int = 1
 
-    for i in range(config.first_policy, len(_reader)):
-        if check_overauthorization(_reader[i], config):
-            overauthorized_list.append(_reader[i][config.id])
-            overauthorization += 1
-        elif _reader[i][config.inactive]:
-            disable_list.append(_reader[i][config.id])
-            disable += 1
+
+def rule_digest(table: RuleTable, i: int) -> str:
+    fields: List[str] = [table.pids[i], table.action_name(i)]
+    for column in [table.src_ip, table.src_port, table.dst_ip, table.dst_port]:
+        fields.append(','.join(f'{column.starts[entry]}-{column.ends[entry]}' for entry in column.span(i)))
+    fields.append(','.join(table.protocol_names[table.protocols[entry]] for entry in table.dst_port.span(i)))
+    return hashlib.sha1(json.dumps(fields).encode()).hexdigest()
+
+
+def increasing_subsequence(positions: List[Optional[int]]) -> set:
+    """
+    Indexes of a longest increasing subsequence of `positions` (None skipped), i.e. the rules
+    which kept their relative order since the previous run.
+    """
+    tails: List[int] = list()
+    tail_indexes: List[int] = list()
+    previous: Dict[int, int] = dict()
+
+    for index, position in enumerate(positions):
+        if position is None:
+            continue
+        k: int = bisect_left(tails, position)
+        if k == len(tails):
+            tails.append(position)
+            tail_indexes.append(index)
         else:
-            reader.append(_reader[i])
+            tails[k] = position
+            tail_indexes[k] = index
+        previous[index] = tail_indexes[k - 1] if k else -1
 
-    with open(config.oa, 'w') as f:
-        f.write(", ".join(overauthorized_list))
+    kept: set = set()
+    index: int = tail_indexes[-1] if tail_indexes else -1
+    while index >= 0:
+        kept.add(index)
+        index = previous[index]
+    return kept
 
-    with open(config.disable, 'w') as f:
-        f.write(", ".join(disable_list))
 
-    pbar = trange(len(reader)-1)
-    for i in pbar:
-        print(reader[i], reader[i+1])
-        detect_partial_conflicts(reader[i], reader[i+1:], config)
+def load_cache(path: str) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    try:
+        with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as f:
+            cache: Dict = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get('version') != CACHE_VERSION:
+        return None
+    return cache
 
 
-def sum(config):
+def dump_cache(path: str, digests: List[str], pairs: List[Tuple[str, str, List[Dict[str, Union[int, str]]]]],
+               coalesce: int = 0):
+    with (gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w')) as f:
+        json.dump({'version': CACHE_VERSION, 'coalesce': coalesce, 'rules': digests, 'pairs': pairs}, f)
 
-    from glob import glob
-    paths: List[str] = glob(os.path.join(config.cdir, '*.json'))
 
-    conflicts: Dict[str, Union[int, List[str]]] = dict()
-    keys: List[str] = ['redundant', 'shadowed', 'general', 'correlated']
+def diff_conflicts(previous: Iterable[Dict[str, Union[int, str]]],
+                   current: Iterable[Dict[str, Union[int, str]]]) -> Dict[str, List[Dict[str, Union[int, str]]]]:
+    before: Counter = Counter(json.dumps(conflict, sort_keys=True) for conflict in previous)
+    after: Counter = Counter(json.dumps(conflict, sort_keys=True) for conflict in current)
+    return {
+        'new': [json.loads(conflict) for conflict in (after - before).elements()],
+        'resolved': [json.loads(conflict) for conflict in (before - after).elements()]
+    }
+
 
-    conflicts['total'] = 0
+def detect_incremental(table: RuleTable, config, stats: Optional[Stats] = None):
+    """
+    Re-analyze only the pairs involving the rules added, modified or moved since the run stored
+    in `config.cache`, the other pairs are copied from the cache by the digests of both rules.
+    The conflicts appearing or disappearing since that run are written to `config.diff`.
+    """
+    stats = stats or Stats()
+
+    with stats.stage('load'):
+        digests: List[str] = [rule_digest(table, i) for i in range(len(table))]
+        cache: Optional[Dict] = load_cache(config.cache)
+        if cache and cache.get('coalesce', 0) != config.coalesce:
+            cache = None
+        previous_pairs: List[List] = cache['pairs'] if cache else list()
 
-    for key in keys:
-        conflicts[key] = 0
-        conflicts[f'{key}_list'] = list()
+    # duplicated rules cannot be matched with the previous run, so they are re-analyzed
+    counts: Counter = Counter(digests)
+    previous_counts: Counter = Counter(cache['rules'] if cache else list())
+    previous_positions: Dict[str, int] = {digest: k for k, digest in enumerate(cache['rules'] if cache else list())}
+
+    kept: set = increasing_subsequence([
+        previous_positions[digest] if counts[digest] == 1 and previous_counts[digest] == 1 else None
+        for digest in digests])
+    dirty: List[bool] = [i not in kept for i in range(len(table))]
+    positions: Dict[str, int] = {digests[i]: i for i in kept}
+
+    cached: Dict[str, List[Tuple[int, List[Dict[str, Union[int, str]]]]]] = dict()
+    for digest_1, digest_2, conflicts in previous_pairs:
+        if digest_1 in positions and digest_2 in positions:
+            cached.setdefault(digest_1, list()).append((positions[digest_2], conflicts))
+
+    with stats.stage('index'):
+        detector: Detector = Detector(table, config)
+
+    # pairs of unchanged rules i < j with j changed
+    pending: Dict[int, List[int]] = dict()
+    with stats.stage('detection'):
+        for j in range(len(table)):
+            if dirty[j]:
+                for i in detector.preceding(j, lambda rule: not dirty[rule]):
+                    pending.setdefault(i, list()).append(j)
+
+    sink: Union[DirectorySink, StreamSink, SpillSink] = open_sink(config, table)
+    pairs: List[Tuple[str, str, List[Dict[str, Union[int, str]]]]] = list()
+    reused: int = 0
+
+    for i in trange(len(table)):
+        by_rule: Dict[int, List[Dict[str, Union[int, str]]]] = dict()
+
+        with stats.stage('detection'):
+            for j in (detector.subsequent(i) if dirty[i] else pending.get(i, list())):
+                conflicts: List[Dict[str, Union[int, str]]] = detector.collect_among(i, [j])
+                if conflicts:
+                    by_rule[j] = conflicts
+
+        if not dirty[i]:
+            for j, conflicts in cached.get(digests[i], list()):
+                by_rule[j] = conflicts
+                reused += 1
+
+        with stats.stage('write'):
+            for j in sorted(by_rule):
+                pairs.append((digests[i], digests[j], by_rule[j]))
+                stats.count_conflicts(by_rule[j])
+            sink.write(table, i, [conflict for j in sorted(by_rule) for conflict in by_rule[j]])
+
+    with stats.stage('write'):
+        sink.close()
+        dump_cache(config.cache, digests, pairs, config.coalesce)
+
+        diff: Dict[str, List[Dict[str, Union[int, str]]]] = diff_conflicts(
+            (conflict for _, _, conflicts in previous_pairs for conflict in conflicts),
+            (conflict for _, _, conflicts in pairs for conflict in conflicts))
+        with open(config.diff, 'w') as f:
+            json.dump(diff, f)
+
+    stats.counters['pairs_reused'] += reused
+    stats.counters['rules_changed'] += dirty.count(True)
+    stats.counters.update(detector.drain()[0])
+
+    print(f'rules: {len(table)}, changed: {dirty.count(True)}, pairs examined: {stats.counters["pairs"]}, '
+          f'pairs reused: {reused}, new conflicts: {len(diff["new"])}, resolved conflicts: {len(diff["resolved"])}')
+
+
+TABLE_MAGIC: bytes = b'FWRULES1'
+
+# arrays of a RuleTable in the order of the compiled file
+TABLE_ARRAYS: List[Tuple[str, str]] = [('actions', 'B'), ('inactive', 'B'), ('action_ids', 'q'), ('protocols', 'q')] + [
+    (f'{column}.{name}', 'q') for column in ['src_ip', 'src_port', 'dst_ip', 'dst_port']
+    for name in ['starts', 'ends', 'offsets', 'groups', 'owners']]
+
+# options changing the compiled table or the lists of skipped rules
+TABLE_OPTIONS: List[str] = ['id', 'inactive', 'src_ip', 'src_port', 'dst_ip', 'dst_port', 'protocol', 'action',
+                            'first_policy', 'private_cloud', 'coalesce']
+
+
+def getattr_path(obj, path: str):
+    for name in path.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+def setattr_path(obj, path: str, value):
+    *parents, name = path.split('.')
+    for parent in parents:
+        obj = getattr(obj, parent)
+    setattr(obj, name, value)
+
+
+def table_source(config) -> Dict[str, Union[str, Dict]]:
+    """The absolute path of the csv and the table options, which identify the compiled tables of the same rules."""
+    return {'fpath': os.path.abspath(config.fpath),
+            'options': {option: getattr(config, option) for option in TABLE_OPTIONS}}
 
-    conflicts['redundant'] = 0
 
-    for path in paths:
-        with open(path, 'r') as cf:
-            data: List[Dict[str, Union[int, str]]] = json.load(cf)
+def table_path(config) -> str:
+    """`<table_cache>/<csv name>.<sha256 of table_source>.<sha256 of the csv>.rules`"""
+    source: str = hashlib.sha256(json.dumps(table_source(config), sort_keys=True).encode()).hexdigest()[:16]
+    digest = hashlib.sha256()
+    with open(config.fpath, 'rb') as f:
+        for chunk in iter(partial(f.read, 1 << 20), b''):
+            digest.update(chunk)
+    name: str = os.path.splitext(os.path.basename(config.fpath))[0]
+    return os.path.join(config.table_cache, f'{name}.{source}.{digest.hexdigest()}.rules')
+
+
+def table_header(path: str) -> Dict:
+    with open(path, 'rb') as f:
+        if f.read(len(TABLE_MAGIC)) != TABLE_MAGIC:
+            raise ValueError(f'{path} is not a compiled table')
+        size: int = int.from_bytes(f.read(8), 'little')
+        return json.loads(f.read(size))
+
+
+def dump_table(path: str, table: RuleTable, overauthorized_list: List[str], disable_list: List[str],
+               source: Optional[Dict[str, Union[str, Dict]]] = None):
+    """
+    Header length (8 bytes) and JSON header after the magic, then the raw arrays of TABLE_ARRAYS, each aligned
+    to 8 bytes. With the `source` of the table (see table_source), the compiled tables of the same csv path and
+    options with outdated contents are removed, those of other csv files or options being left alone.
+    """
+    arrays: List[bytes] = [bytes(getattr_path(table, name)) if typecode == 'B' else getattr_path(table, name).tobytes()
+                           for name, typecode in TABLE_ARRAYS]
+    header: bytes = json.dumps({
+        'pids': table.pids, 'action_names': table.action_names, 'protocol_names': table.protocol_names,
+        'overauthorized': overauthorized_list, 'disabled': disable_list, 'source': source,
+        'lengths': [len(data) for data in arrays]}).encode()
+
+    def _pad_(size: int) -> bytes:
+        return bytes(-size % 8)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(TABLE_MAGIC + len(header).to_bytes(8, 'little') + header + _pad_(len(header)))
+        for data in arrays:
+            f.write(data + _pad_(len(data)))
+    os.replace(path + '.tmp', path)
+    if source is None:
+        return
+
+    directory, current = os.path.split(path)
+    prefix: str = current[:-len('.rules')].rsplit('.', 1)[0] + '.'
+    for name in os.listdir(directory or '.'):
+        # the same csv name and source digest followed by another contents digest, the recorded source telling
+        # apart the csv files whose digests would collide
+        if name == current or not name.startswith(prefix) or not name.endswith('.rules'):
+            continue
+        stale: str = os.path.join(directory, name)
+        try:
+            if table_header(stale).get('source') == source:
+                os.remove(stale)
+        except (OSError, ValueError):
+            # removed or being written by another run
+            pass
+
+
+def map_table(path: str) -> Tuple[RuleTable, List[str], List[str]]:
+    """Load a compiled table, its arrays being memory views of the mapped file (no copy)."""
+    import mmap
+
+    with open(path, 'rb') as f:
+        buffer: mmap.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view: memoryview = memoryview(buffer)
+    if bytes(view[:len(TABLE_MAGIC)]) != TABLE_MAGIC:
+        raise ValueError(f'{path} is not a compiled table')
+    size: int = int.from_bytes(view[8:16], 'little')
+    header: Dict = json.loads(bytes(view[16:16 + size]))
+
+    table: RuleTable = RuleTable()
+    table.pids, table.action_names, table.protocol_names = \
+        header['pids'], header['action_names'], header['protocol_names']
+    table.action_codes = {name: code for code, name in enumerate(table.action_names)}
+    table.protocol_codes = {name: code for code, name in enumerate(table.protocol_names)}
+
+    offset: int = 16 + size + -size % 8
+    for (name, typecode), length in zip(TABLE_ARRAYS, header['lengths']):
+        setattr_path(table, name, view[offset:offset + length].cast(typecode))
+        offset += length + -length % 8
+
+    table.mapped, table.buffer = path, buffer
+    return table, header['overauthorized'], header['disabled']
+
+
+def map_rules(path: str) -> RuleTable:
+    return map_table(path)[0]
+
+
+def load_table(config, stats: Optional[Stats] = None) -> Tuple[RuleTable, List[str], List[str]]:
+    stats = stats or Stats()
+    overauthorized_list: List[str] = list()
+    disable_list: List[str] = list()
+
+    def _active_policies_() -> Iterator[List[str]]:
+        with stats.stage('load'):
+            policies: Iterator[List[str]] = iter(read_policies(config))
+
+        while True:
+            with stats.stage('load'):
+                policy: Optional[List[str]] = next(policies, None)
+            if policy is None:
+                return
+
+            with stats.stage('overauthorization'):
+                if check_overauthorization(policy, config):
+                    overauthorized_list.append(policy[config.id])
+                    continue
+                if policy[config.inactive]:
+                    disable_list.append(policy[config.id])
+                    continue
+            yield policy
+
+    cached: str = ''
+    if config.table_cache and not config.test:
+        with stats.stage('load'):
+            cached = table_path(config)
+
+    if cached and os.path.exists(cached):
+        with stats.stage('load'):
+            table, overauthorized_list, disable_list = map_table(cached)
+        stats.counters['table_cache_hit'] += 1
+    else:
+        with stats.stage('parse'):
+            table = compile_rules(_active_policies_(), config)
+        if cached:
+            with stats.stage('write'):
+                dump_table(cached, table, overauthorized_list, disable_list, table_source(config))
 
-        for c in data:
+    stats.counters['rules'] = len(table)
+    stats.counters['overauthorized'] = len(overauthorized_list)
+    stats.counters['inactive'] = len(disable_list)
+    return table, overauthorized_list, disable_list
+
+
+def peak_rss(children: bool = False) -> int:
+    """
+    Peak resident memory of the process, or of the largest of its terminated children (the workers), in KB,
+    0 where the resource module is missing.
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+
+
+def main(config, stats: Optional[Stats] = None):
+    stats = stats or Stats()
+    table, overauthorized_list, disable_list = load_table(config, stats)
+
+    with stats.stage('write'):
+        with open(config.oa, 'w') as f:
+            f.write(", ".join(overauthorized_list))
+
+        with open(config.disable, 'w') as f:
+            f.write(", ".join(disable_list))
+
+    if config.memory and (config.coalesce or config.cache):
+        raise ValueError('--memory cannot be combined with --coalesce, whose sockets are not fixed-width, '
+                         'or with --cache, which holds every pair')
+
+    selected: Optional[List[int]] = None
+    if config.scope:
+        if config.cache:
+            raise ValueError('--scope cannot be combined with --cache, the cache holds every pair')
+        selected = detect_scoped(table, config, stats)
+    elif config.cache:
+        detect_incremental(table, config, stats)
+    else:
+        detect_all_conflicts(table, config, stats)
+
+    if config.memory:
+        stats.counters['runs'] = len(run_paths(config))
+        stats.counters['peak_rss_kb'] = peak_rss()
+        if config.workers > 1:
+            stats.counters['peak_rss_workers_kb'] = peak_rss(children=True)
+        if config.render:
+            with stats.stage('render'):
+                render_conflicts(config)
+
+    if config.residual:
+        dead: List[Dict[str, Union[str, List[str]]]] = find_dead_rules(table, config, stats, selected)
+        with stats.stage('write'):
+            with open(config.residual, 'w') as f:
+                json.dump(dead, f, indent=2)
+
+    if config.compact:
+        compact_rules(config, stats)
+
+
+def summary_shards(paths: List[str], parts: int) -> List[Tuple[str, int, int]]:
+    """
+    Shards of the conflict files as (path, start, end) byte ranges; uncompressed JSON Lines files are split
+    into `parts` ranges, a range holding the lines starting in it, other files are whole shards (end = -1).
+    """
+    shards: List[Tuple[str, int, int]] = list()
+    for path in paths:
+        size: int = os.path.getsize(path)
+        if not path.endswith('.jsonl') or parts <= 1:
+            shards.append((path, 0, -1))
+            continue
+        bounds: List[int] = [size * k // parts for k in range(parts + 1)]
+        shards += [(path, bounds[k], bounds[k + 1]) for k in range(parts) if bounds[k] < bounds[k + 1]]
+    return shards
+
+
+def read_shard(shard: Tuple[str, int, int]) -> Iterator[Dict[str, Union[int, str]]]:
+    path, start, end = shard
+    if end < 0:
+        yield from read_conflicts(path)
+        return
+
+    with open(path, 'rb') as cf:
+        if start:
+            cf.seek(start - 1)
+            cf.readline()
+        while cf.tell() < end:
+            line: bytes = cf.readline()
+            if not line:
+                break
+            if line.strip():
+                yield json.loads(line)
+
+
+CONFLICT_TYPES: List[str] = ['redundant', 'shadowed', 'general', 'correlated']
+
+
+def _summarize_shards_(task: Tuple[List[Tuple[str, int, int]], str]) -> Tuple[Counter, Dict[str, Counter], List[str]]:
+    shards, spill_dir = task
+
+    counts: Counter = Counter()
+    rules: Dict[str, Counter] = dict()
+    spills: Dict[str, TextIO] = {
+        key: tempfile.NamedTemporaryFile('w', dir=spill_dir, suffix=f'.{key}', delete=False) for key in CONFLICT_TYPES}
+
+    for shard in shards:
+        for c in read_shard(shard):
             ctype: str = c['conflict']
-            conflicts['total'] += 1
-            conflicts[ctype] += 1
-            conflicts[f'{ctype}_list'].append(f"{c['pre']}->{c['sub']}")
+            counts[ctype] += 1
+            spills[ctype].write(f"\t\t{c['pre']}->{c['sub']}\n")
+            for pid in {c['pre'], c['sub']}:
+                rules.setdefault(pid, Counter())[ctype] += 1
+
+    for spill in spills.values():
+        spill.close()
+    return counts, rules, [spills[key].name for key in CONFLICT_TYPES]
+
+
+def _summarize_runs_(task: Tuple[List[str], str]) -> Tuple[Counter, Dict[str, Counter], List[str]]:
+    """_summarize_shards_ of the runs of --memory, read in detection order."""
+    runs, spill_dir = task
+    pids: List[str] = map_rules(os.path.join(os.path.dirname(runs[0]), 'conflicts.rules')).pids
+
+    counts: Counter = Counter()
+    rules: Dict[str, Counter] = dict()
+    spills: List[TextIO] = [
+        tempfile.NamedTemporaryFile('w', dir=spill_dir, suffix=f'.{key}', delete=False) for key in CONFLICT_TYPES]
 
-    with open(config.report, 'w+') as f:
-        f.write(f"Total: {conflicts['total']}\n")
+    for record in read_runs(runs):
+        i, j = struct.unpack_from('>II', record)
+        ctype: str = CONFLICT_TYPES[record[-1]]
+        counts[ctype] += 1
+        spills[record[-1]].write(f"\t\t{pids[i]}->{pids[j]}\n")
+        for pid in {pids[i], pids[j]}:
+            rules.setdefault(pid, Counter())[ctype] += 1
 
-        for key in keys:
-            f.write(f"\t{key.capitalize()}: {conflicts[key]}\n")
-            for id_pair in conflicts[f"{key}_list"]:
-                f.write(f'\t\t{id_pair}\n')
+    for spill in spills:
+        spill.close()
+    return counts, rules, [spill.name for spill in spills]
+
+
+def sum(config):
+    """
+    Summarize the conflict files under cdir into `config.report`, and the per-rule counts with
+    the `config.top` most conflicting rules into the JSON file next to it. Shards are read by
+    `config.workers` processes, the pairs of every type being spilled to temporary files instead of memory.
+    The runs of --memory are read instead of the conflict files if there are any.
+    """
+    import shutil
+
+    paths: List[str] = conflict_paths(config)
+    runs: List[str] = run_paths(config)
+    workers: int = max(config.workers, 1)
+    shards: List[Tuple[str, int, int]] = summary_shards(paths, workers)
+
+    counts: Counter = Counter()
+    rules: Dict[str, Counter] = dict()
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        batches: int = min(len(shards), workers * 4) or 1
+        tasks: List[Tuple[List[Tuple[str, int, int]], str]] = [
+            (shards[len(shards) * k // batches:len(shards) * (k + 1) // batches], spill_dir) for k in range(batches)]
+
+        spills: List[List[str]] = list()
+        if runs:
+            results = [_summarize_runs_((runs, spill_dir))]
+        elif workers > 1:
+            with Pool(workers) as pool:
+                results = list(pool.imap(_summarize_shards_, tasks))
+        else:
+            results = map(_summarize_shards_, tasks)
+
+        for shard_counts, shard_rules, shard_spills in results:
+            counts.update(shard_counts)
+            for pid, rule_counts in shard_rules.items():
+                rules.setdefault(pid, Counter()).update(rule_counts)
+            spills.append(shard_spills)
+
+        with open(config.report, 'w+') as f:
+            f.write(f"Total: {builtins.sum(counts.values())}\n")
+
+            for k, key in enumerate(CONFLICT_TYPES):
+                f.write(f"\t{key.capitalize()}: {counts[key]}\n")
+                for shard_spills in spills:
+                    with open(shard_spills[k], 'r') as spill:
+                        shutil.copyfileobj(spill, f)
+
+    per_rule: Dict[str, Dict[str, int]] = {
+        pid: dict(total=builtins.sum(rule_counts.values()), **rule_counts) for pid, rule_counts in rules.items()}
+    top: List[str] = heapq.nlargest(config.top, per_rule, key=lambda pid: per_rule[pid]['total'])
+
+    with open(os.path.splitext(config.report)[0] + '.json', 'w') as f:
+        json.dump({
+            'total': builtins.sum(counts.values()),
+            'conflicts': {key: counts[key] for key in CONFLICT_TYPES},
+            'rules': per_rule,
+            'top': [dict(id=pid, **per_rule[pid]) for pid in top]
+        }, f)
 
 
 def clear_conflict(config):
-    from glob import glob
-    paths: List[str] = glob(os.path.join(config.cdir, '*.json'))
+    paths: List[str] = conflict_paths(config) + run_paths(config)
+    if os.path.exists(os.path.join(config.cdir, 'conflicts.rules')):
+        paths.append(os.path.join(config.cdir, 'conflicts.rules'))
     for path in paths:
         os.remove(path)
 
 
-if __name__ == '__main__':
-
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
 
     # columns of fields
@@ -508,22 +2507,81 @@ if __name__ == '__main__':
                         help='the first line of policies in csv, default 1')
     parser.add_argument('--private_cloud', type=int, default=1,
                         help='if the firewall is belonging to private cloud')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes for detection, default 1 (serial)')
+    parser.add_argument('--chunks', type=int, default=8,
+                        help='chunks of the pair space per worker, default 8')
+    parser.add_argument('--engine', type=str, default='auto', choices=['auto', 'python', 'numpy'],
+                        help='pairwise engine, default auto (numpy if installed)')
+    parser.add_argument('--prune', type=int, default=1,
+                        help='if only the pairs overlapping in every dimension are examined, default 1')
+    parser.add_argument('--coalesce', type=int, default=0,
+                        help='if the ranges of every group are merged and groups are compared as a whole, '
+                             'instead of every combination of ranges')
+    parser.add_argument('--table_cache', type=str, default='',
+                        help='directory of the compiled tables, mapped instead of parsing the csv again, disabled if empty')
+    parser.add_argument('--scope', type=str, default='',
+                        help="only the conflicts of the rules overlapping filters such as 'ip=10.20.0.0/16 dst_port=tcp_443'")
+    parser.add_argument('--lazy', type=int, default=0,
+                        help='if the csv is read row by row instead of being loaded at once')
+    parser.add_argument('--stream', type=int, default=0,
+                        help='if the conflicts are appended to cdir/conflicts.jsonl instead of a json file per rule')
+    parser.add_argument('--gzip', type=int, default=0,
+                        help='if the stream of conflicts is compressed (cdir/conflicts.jsonl.gz)')
+    parser.add_argument('--buffer', type=int, default=4096,
+                        help='conflicts held in memory before being written to the stream, default 4096')
+    parser.add_argument('--memory', type=int, default=0,
+                        help='MB of fixed-width conflict records held in memory before a sorted run is spilled to '
+                             'cdir, disabled if 0')
+    parser.add_argument('--render', type=int, default=0,
+                        help='if the runs of --memory are also rendered into cdir/conflicts.jsonl')
 
     # filenames
     parser.add_argument('--oa', type=str, default='xoverauthorization1.txt')
     parser.add_argument('--disable', type=str, default='xdisable.txt')
     parser.add_argument('--report', type=str, default='xreport.txt')
+    parser.add_argument('--cache', type=str, default='',
+                        help='file of the pair results kept for incremental runs (.gz for gzip), disabled if empty')
+    parser.add_argument('--diff', type=str, default='xdiff.json',
+                        help='new and resolved conflicts since the cached run')
+    parser.add_argument('--top', type=int, default=20,
+                        help='most conflicting rules listed in the json summary next to the report, default 20')
+    parser.add_argument('--residual', type=str, default='',
+                        help='json file of the rules never matched in first-match order, disabled if empty')
+    parser.add_argument('--box_cap', type=int, default=4096,
+                        help='boxes of the unmatched space of a rule kept per protocol by --residual, default 4096')
+    parser.add_argument('--compact', type=str, default='',
+                        help='csv of the active rules without the unneeded ones and with adjacent ones merged, '
+                             'disabled if empty')
+    parser.add_argument('--stats', type=str, default='',
+                        help='json file of the stage timings and counters, disabled if empty')
+    parser.add_argument('--trace', type=str, default='',
+                        help='json lines file of the sampled rules traced in detection, disabled if empty')
+    parser.add_argument('--trace_rate', type=float, default=0.001,
+                        help='fraction of the rules traced, default 0.001')
+
+    return parser
 
-    config = parser.parse_args()
+
+if __name__ == '__main__':
+
+    config = build_parser().parse_args()
 
     try:
         os.makedirs(config.cdir)
     except:
         pass
 
-    clear_conflict(config)
-    main(config)
+    stats = Stats()
+
+    with stats.stage('clear'):
+        clear_conflict(config)
+    main(config, stats)
 
     if config.sum:
-        sum(config)
+        with stats.stage('summarize'):
+            sum(config)
+
+    if config.stats:
+        stats.dump(config.stats)
 
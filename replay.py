@@ -0,0 +1,270 @@
+# -*- coding:utf-8 -*-
+import csv
+import gzip
+import json
+import math
+
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import islice
+from collections import Counter
+from typing import List, Dict, Optional, Iterator, Tuple, TextIO
+
+import patch
+from patch import np
+
+# protocol numbers of the flow logs, other numbers are kept as they are
+PROTOCOL_NUMBERS: Dict[str, str] = {'1': 'icmp', '6': 'tcp', '17': 'udp', '47': 'gre', '50': 'esp', '58': 'icmpv6'}
+
+
+# rules per chunk of the bitsets
+CHUNK: int = 1 << 12
+
+
+class Dimension:
+    """
+    Elementary intervals of one field: the bounds of all the ranges cut the field into intervals [points[k], points[k+1])
+    which every range either covers or misses, and bitsets[k] has bit i set if rule i covers interval k.
+    The bitsets are tuples of chunks of CHUNK rules, so that consecutive intervals share the chunks they do not change
+    and the first match is found without ANDing the chunks after it.
+    """
+
+    __slots__ = ['points', 'bitsets', 'np_points']
+
+    def __init__(self, ranges: List[Tuple[Tuple[int, int], ...]], size: int):
+        points: List[int] = sorted({0}.union(*({bounds[0], bounds[1] + 1} for group in ranges for bounds in group)))
+        position: Dict[int, int] = {point: k for k, point in enumerate(points)}
+
+        adds: List[Dict[int, List[int]]] = [dict() for _ in points]
+        removes: List[Dict[int, List[int]]] = [dict() for _ in points]
+        for rule, group in enumerate(ranges):
+            # the ranges of a group are coalesced, a rule never leaves and enters an interval at the same point
+            for start, end in group:
+                adds[position[start]].setdefault(rule // CHUNK, list()).append(rule % CHUNK)
+                removes[position[end + 1]].setdefault(rule // CHUNK, list()).append(rule % CHUNK)
+
+        self.points: array = array('q', points)
+        self.bitsets: List[Tuple[int, ...]] = list()
+        current: List[int] = [0] * ((size + CHUNK - 1) // CHUNK)
+        for k in range(len(points)):
+            for chunk, rules in removes[k].items():
+                current[chunk] &= ~bitset(rules)
+            for chunk, rules in adds[k].items():
+                current[chunk] |= bitset(rules)
+            self.bitsets.append(tuple(current))
+
+        if np is not None:
+            self.np_points = np.frombuffer(self.points, dtype=np.int64)
+
+    def locate(self, value: int) -> int:
+        return bisect_right(self.points, value) - 1
+
+    def locate_all(self, values: 'np.ndarray') -> 'np.ndarray':
+        return np.searchsorted(self.np_points, values, side='right') - 1
+
+
+def bitset(rules: List[int]) -> int:
+    bits: bytearray = bytearray(CHUNK // 8)
+    for rule in rules:
+        bits[rule >> 3] |= 1 << (rule & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class Classifier:
+    """
+    First-match classification of packets by the bit-vector scheme: one Dimension per field (dst_port per protocol,
+    rules of protocol any being in all of them), the rules matching a packet being the AND of the bitsets of its
+    intervals, and the first of them the lowest bit set.
+    """
+
+    def __init__(self, table: patch.RuleTable):
+        self.table: patch.RuleTable = table
+        size: int = len(table)
+
+        def _ranges_(column: patch.RangeColumn, protocols: Optional[set] = None) -> List[Tuple[Tuple[int, int], ...]]:
+            return [patch.coalesce_group(tuple(
+                (column.starts[entry], column.ends[entry]) for entry in column.span(rule)
+                if protocols is None or table.protocol_names[table.protocols[entry]].lower() in protocols))
+                for rule in range(size)]
+
+        self.src_ip: Dimension = Dimension(_ranges_(table.src_ip), size)
+        self.src_port: Dimension = Dimension(_ranges_(table.src_port), size)
+        self.dst_ip: Dimension = Dimension(_ranges_(table.dst_ip), size)
+
+        # dst_port of the protocols of the rules, the last one for the other protocols (rules of protocol any only)
+        names: List[str] = sorted({name.lower() for name in table.protocol_names} - {'any'})
+        self.protocol_codes: Dict[str, int] = {name: code for code, name in enumerate(names)}
+        self.dst_port: List[Dimension] = [Dimension(_ranges_(table.dst_port, {name, 'any'}), size) for name in names]
+        self.dst_port.append(Dimension(_ranges_(table.dst_port, {'any'}), size))
+
+    def protocol_code(self, protocol: str) -> int:
+        protocol = protocol.strip().lower()
+        return self.protocol_codes.get(PROTOCOL_NUMBERS.get(protocol, protocol), len(self.dst_port) - 1)
+
+    def first_match(self, key: Tuple[int, int, int, int, int]) -> int:
+        """The first rule matching the intervals `key` (src_ip, src_port, dst_ip, protocol, dst_port), -1 if none."""
+        src_ip, src_port, dst_ip, protocol, dst_port = key
+        chunks = zip(self.src_ip.bitsets[src_ip], self.dst_ip.bitsets[dst_ip],
+                     self.dst_port[protocol].bitsets[dst_port], self.src_port.bitsets[src_port])
+        for chunk, (bits_1, bits_2, bits_3, bits_4) in enumerate(chunks):
+            bits: int = bits_1 & bits_2 & bits_3 & bits_4
+            if bits:
+                return chunk * CHUNK + (bits & -bits).bit_length() - 1
+        return -1
+
+    def locate(self, flows: List[array]) -> Counter:
+        """Number of flows (columns src_ip, src_port, dst_ip, dst_port, protocol code) per interval key."""
+        if np is None:
+            return Counter((self.src_ip.locate(src_ip), self.src_port.locate(src_port), self.dst_ip.locate(dst_ip),
+                            protocol, self.dst_port[protocol].locate(dst_port))
+                           for src_ip, src_port, dst_ip, dst_port, protocol in zip(*flows))
+
+        src_ip, src_port, dst_ip, dst_port, protocols = (np.frombuffer(column, dtype=np.int64) for column in flows)
+        keys: List[np.ndarray] = [self.src_ip.locate_all(src_ip), self.src_port.locate_all(src_port),
+                                  self.dst_ip.locate_all(dst_ip), protocols, np.empty_like(dst_port)]
+        for protocol in np.unique(protocols).tolist():
+            rows: np.ndarray = protocols == protocol
+            keys[4][rows] = self.dst_port[protocol].locate_all(dst_port[rows])
+
+        # the keys are numbered in one integer to be counted, unless there are too many of them
+        sizes: Tuple[int, ...] = (len(self.src_ip.points), len(self.src_port.points), len(self.dst_ip.points),
+                                  len(self.dst_port), max(len(dimension.points) for dimension in self.dst_port))
+        if math.prod(sizes) < 1 << 62:
+            unique, counts = np.unique(np.ravel_multi_index(keys, sizes), return_counts=True)
+            unique = np.stack(np.unravel_index(unique, sizes), axis=1)
+        else:
+            unique, counts = np.unique(np.stack(keys, axis=1), axis=0, return_counts=True)
+        return Counter(dict(zip(map(tuple, unique.tolist()), counts.tolist())))
+
+    def classify(self, flows: List[array]) -> Counter:
+        """Number of flows per first matching rule, -1 counting the flows falling through to the default."""
+        hits: Counter = Counter()
+        for key, count in self.locate(flows).items():
+            hits[self.first_match(key)] += count
+        return hits
+
+
+@lru_cache(maxsize=1 << 20)
+def flow_address(address: str) -> int:
+    return patch.ip2int(address)
+
+
+def flow_port(port: str) -> int:
+    # flows of protocols without ports (e.g. icmp) may leave them empty
+    value: int = int(port) if port.strip() else 0
+    if not 0 <= value <= 65535:
+        raise ValueError(f"port {port} is out of 0-65535")
+    return value
+
+
+def open_flows(path: str) -> TextIO:
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='')
+    return open(path, 'r', newline='')
+
+
+def read_flows(config, classifier: Classifier, stats: patch.Stats) -> Iterator[List[array]]:
+    """
+    Batches of `config.batch` flows of `config.flows` as columns (src_ip, src_port, dst_ip, dst_port, protocol code),
+    the malformed rows being counted and skipped.
+    """
+    with open_flows(config.flows) as f:
+        rows: Iterator[List[str]] = islice(csv.reader(f), config.first_flow, None)
+        while True:
+            with stats.stage('load'):
+                batch: List[List[str]] = list(islice(rows, config.batch))
+            if not batch:
+                return
+
+            with stats.stage('parse'):
+                flows: List[array] = [array('q') for _ in range(5)]
+                for row in batch:
+                    try:
+                        flow: Tuple[int, ...] = (
+                            flow_address(row[config.flow_src_ip]), flow_port(row[config.flow_src_port]),
+                            flow_address(row[config.flow_dst_ip]), flow_port(row[config.flow_dst_port]),
+                            classifier.protocol_code(row[config.flow_protocol]))
+                    except (ValueError, IndexError):
+                        stats.counters['flows_malformed'] += 1
+                        continue
+                    for column, value in zip(flows, flow):
+                        column.append(value)
+            yield flows
+
+
+def load_rules(config, stats: patch.Stats) -> Tuple[patch.RuleTable, set]:
+    """The active rules, overauthorized ones included since the firewall matches them all the same."""
+    with stats.stage('load'):
+        policies: List[List[str]] = [policy for policy in patch.read_policies(config) if not policy[config.inactive]]
+    with stats.stage('overauthorization'):
+        overauthorized: set = {policy[config.id] for policy in policies if patch.check_overauthorization(policy, config)}
+    with stats.stage('parse'):
+        table: patch.RuleTable = patch.compile_rules(policies, config)
+    return table, overauthorized
+
+
+def replay(config, stats: Optional[patch.Stats] = None) -> Dict:
+    stats = stats or patch.Stats()
+    table, overauthorized = load_rules(config, stats)
+    with stats.stage('index'):
+        classifier: Classifier = Classifier(table)
+
+    hits: Counter = Counter()
+    flows: int = 0
+    for batch in read_flows(config, classifier, stats):
+        with stats.stage('classify'):
+            hits.update(classifier.classify(batch))
+        flows += len(batch[0])
+
+    default: int = hits.pop(-1, 0)
+    seconds: float = sum(stats.stages.values())
+    report: Dict = {
+        'flows': flows,
+        'malformed': stats.counters['flows_malformed'],
+        'matched': flows - default,
+        'default': default,
+        'seconds': seconds,
+        'rules': [{'rule': table.pids[rule], 'action': table.action_name(rule), 'hits': hits[rule],
+                   'overauthorized': table.pids[rule] in overauthorized} for rule in range(len(table))],
+        'never_hit': [table.pids[rule] for rule in range(len(table)) if not hits[rule]]
+    }
+    with open(config.hits, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    stats.counters['flows'] += flows
+    stats.counters['flows_default'] += default
+    print(f"flows: {flows} ({flows / max(seconds, 1e-9) * 60:,.0f} per minute), matched: {flows - default}, "
+          f"default: {default}, malformed: {report['malformed']}, "
+          f"rules never hit: {len(report['never_hit'])} of {len(table)}")
+    return report
+
+
+if __name__ == '__main__':
+
+    parser = patch.build_parser()
+    parser.description = 'replay a csv of flows through the rules of fpath in first-match order and count the hits'
+    parser.add_argument('--flows', type=str, required=True,
+                        help='csv of the flows, compressed if it ends with .gz')
+    parser.add_argument('--first_flow', type=int, default=0,
+                        help='the first line of flows in the csv, default 0')
+    parser.add_argument('--flow_src_ip', type=int, default=0,
+                        help='column of the source address of flows, default 0')
+    parser.add_argument('--flow_src_port', type=int, default=1,
+                        help='column of the source port of flows, default 1')
+    parser.add_argument('--flow_dst_ip', type=int, default=2,
+                        help='column of the destination address of flows, default 2')
+    parser.add_argument('--flow_dst_port', type=int, default=3,
+                        help='column of the destination port of flows, default 3')
+    parser.add_argument('--flow_protocol', type=int, default=4,
+                        help='column of the protocol (name or number) of flows, default 4')
+    parser.add_argument('--batch', type=int, default=1 << 16,
+                        help='flows classified at once, default 65536')
+    parser.add_argument('--hits', type=str, default='hits.json',
+                        help='json file of the hits of every rule, the rules never hit and the default flows')
+
+    config = parser.parse_args()
+    stats: patch.Stats = patch.Stats()
+    replay(config, stats)
+    if config.stats:
+        stats.dump(config.stats)
@@ -0,0 +1,267 @@
+# -*- coding:utf-8 -*-
+import io
+import os
+import csv
+import sys
+import json
+import socketserver
+
+from time import perf_counter
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+from typing import List, Dict, Union, Optional, Callable
+
+import patch
+
+
+class RuleService:
+    """
+    Keeps the compiled rules of `config.fpath` and their index in memory and answers what-if queries:
+    the conflicts of a rule, of a proposed rule inserted at some position, and of deleting a rule.
+    The rules are reloaded when the file changes.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.mtime: Optional[int] = None
+        self.detect: Callable[[patch.RuleTable, int, int], List[Dict[str, Union[int, str]]]] = \
+            patch.detect_conflicts_between_groups if config.coalesce else patch.detect_conflicts_between_policies
+        self.reload()
+
+    def modified(self) -> Optional[int]:
+        if self.config.test:
+            return None
+        return os.stat(self.config.fpath).st_mtime_ns
+
+    def reload(self):
+        start: float = perf_counter()
+        mtime: Optional[int] = self.modified()
+
+        table, overauthorized_list, disable_list = patch.load_table(self.config)
+        # proposed rules are appended to the table, which a compiled table mapped by --table_cache does not allow
+        table.unmap()
+        index: patch.CandidateIndex = patch.CandidateIndex(table)
+
+        # the earlier rules deciding the packets of the dead rules, to find the rules revived by a deletion
+        dead: Dict[int, List[int]] = dict()
+        for rule in range(len(table)):
+            earlier: List[int] = index.overlapping(rule, lambda earlier: earlier < rule, wildcard=True)
+            space, deciding = patch.residual_space(table, rule, earlier, self.config.box_cap)
+            if space.empty():
+                dead[rule] = deciding
+
+        self.table: patch.RuleTable = table
+        self.index: patch.CandidateIndex = index
+        self.dead: Dict[int, List[int]] = dead
+        self.positions: Dict[str, int] = {pid: rule for rule, pid in enumerate(table.pids)}
+        self.skipped: Dict[str, str] = {pid: 'overauthorized' for pid in overauthorized_list}
+        self.skipped.update({pid: 'inactive' for pid in disable_list})
+        self.mtime = mtime
+
+        print(f'loaded {len(table)} rules in {perf_counter() - start:.3f}s', file=sys.stderr)
+
+    def refresh(self):
+        try:
+            if self.modified() == self.mtime:
+                return
+            self.reload()
+        except (OSError, ValueError) as error:
+            # the file may be half written, moved or deleted, the previous rules are kept until the next query
+            print(f'reload failed: {error}', file=sys.stderr)
+
+    def position(self, pid: str) -> int:
+        if pid in self.skipped:
+            raise ValueError(f'rule {pid} is {self.skipped[pid]}, it is not analyzed')
+        if pid not in self.positions:
+            raise ValueError(f'rule {pid} does not exist')
+        return self.positions[pid]
+
+    def conflicts_of(self, rule: int) -> List[Dict[str, Union[int, str]]]:
+        conflicts: List[Dict[str, Union[int, str]]] = list()
+        for other in self.index.overlapping(rule, lambda other: other != rule):
+            if other < rule:
+                conflicts += self.detect(self.table, other, rule)
+            else:
+                conflicts += self.detect(self.table, rule, other)
+        return conflicts
+
+    def dead_of(self, rule: int) -> Optional[Dict[str, Union[str, List[str]]]]:
+        if rule not in self.dead:
+            return None
+        return patch.dead_rule(self.table, rule, self.dead[rule], self.config.box_cap)
+
+    def query_conflicts(self, request: Dict) -> Dict:
+        rule: int = self.position(str(request['rule']))
+        return {'rule': self.table.pids[rule], 'conflicts': self.conflicts_of(rule), 'dead': self.dead_of(rule)}
+
+    def query_delete(self, request: Dict) -> Dict:
+        """The conflicts resolved by deleting the rule, and the dead rules it makes reachable again."""
+        rule: int = self.position(str(request['rule']))
+
+        revived: List[str] = list()
+        for other, deciding in self.dead.items():
+            if rule not in deciding:
+                continue
+            earlier: List[int] = self.index.overlapping(other, lambda earlier: earlier < other and earlier != rule,
+                                                        wildcard=True)
+            space, _ = patch.residual_space(self.table, other, earlier, self.config.box_cap)
+            if not space.empty():
+                revived.append(self.table.pids[other])
+
+        return {'rule': self.table.pids[rule], 'resolved': self.conflicts_of(rule), 'revived': revived}
+
+    def query_insert(self, request: Dict) -> Dict:
+        """
+        The conflicts of a proposed rule (a csv row in the configured columns) inserted before the rule `before`,
+        or at `position` among the analyzed rules, by default after all of them.
+        """
+        policy: Union[str, List[str]] = request['rule']
+        if isinstance(policy, str):
+            policy = next(csv.reader(io.StringIO(policy)), list())
+        if not isinstance(policy, list) or not all(isinstance(field, str) for field in policy):
+            raise ValueError('rule must be a csv row or a list of its fields as strings')
+        columns: List[int] = [self.config.id, self.config.inactive, self.config.src_ip, self.config.src_port,
+                              self.config.dst_ip, self.config.dst_port, self.config.protocol, self.config.action]
+        if len(policy) <= max(columns):
+            raise ValueError(f'rule has {len(policy)} fields, the configured columns need {max(columns) + 1}')
+
+        if patch.check_overauthorization(policy, self.config):
+            return {'rule': policy[self.config.id], 'overauthorized': True, 'conflicts': list(), 'dead': None}
+
+        if 'before' in request:
+            position: int = self.position(str(request['before']))
+        else:
+            position = request.get('position', len(self.table))
+            if not isinstance(position, (int, str)):
+                raise ValueError('position must be an integer')
+            position = min(max(int(position), 0), len(self.table))
+
+        table: patch.RuleTable = self.table
+        new: int = len(table)
+        try:
+            table.append(policy, self.config)
+            others: List[int] = self.index.overlapping(new, lambda other: other < new)
+            earlier: List[int] = [other for other in others if other < position]
+
+            conflicts: List[Dict[str, Union[int, str]]] = list()
+            for other in earlier:
+                conflicts += self.detect(table, other, new)
+            for other in others[len(earlier):]:
+                conflicts += self.detect(table, new, other)
+
+            # the rules of protocol any cut the packets of the other protocols too
+            space, deciding = patch.residual_space(
+                table, new, self.index.overlapping(new, lambda other: other < position, wildcard=True),
+                self.config.box_cap)
+            dead: Optional[Dict[str, Union[str, List[str]]]] = \
+                patch.dead_rule(table, new, deciding, self.config.box_cap) if space.empty() else None
+        finally:
+            # a rule failing to parse is not appended
+            if len(table) > new:
+                table.pop(policy, self.config)
+
+        return {'rule': policy[self.config.id], 'position': position, 'overauthorized': False,
+                'conflicts': conflicts, 'dead': dead}
+
+    def answer(self, request: Dict) -> Dict:
+        start: float = perf_counter()
+        queries: Dict[str, Callable[[Dict], Dict]] = {
+            'conflicts': self.query_conflicts, 'delete': self.query_delete, 'insert': self.query_insert}
+
+        try:
+            if not isinstance(request, dict):
+                raise ValueError('a request must be a json object')
+            self.refresh()
+            if request.get('query') not in queries:
+                raise ValueError(f"unknown query '{request.get('query')}', expected one of {', '.join(queries)}")
+            response: Dict = queries[request['query']](request)
+        except (KeyError, ValueError, IndexError) as error:
+            response = {'error': f'missing field {error}' if isinstance(error, KeyError) else str(error)}
+
+        response['ms'] = (perf_counter() - start) * 1000
+        return response
+
+
+def http_handler(service: RuleService) -> type:
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def reply(self, response: Dict):
+            body: bytes = json.dumps(response).encode()
+            self.send_response(400 if 'error' in response else 200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            # e.g. GET /conflicts?rule=12
+            url = urlparse(self.path)
+            request: Dict = dict(parse_qsl(url.query))
+            request['query'] = url.path.strip('/')
+            self.reply(service.answer(request))
+
+        def do_POST(self):
+            try:
+                request: Dict = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError as error:
+                self.reply({'error': f'malformed json: {error}'})
+                return
+            self.reply(service.answer(request))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def unix_handler(service: RuleService) -> type:
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            # one json request per line, answered by one json line
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    response: Dict = service.answer(json.loads(line))
+                except ValueError as error:
+                    response = {'error': f'malformed json: {error}'}
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+                self.wfile.flush()
+
+    return Handler
+
+
+if __name__ == '__main__':
+
+    parser = patch.build_parser()
+    parser.description = 'answer conflict queries about the rules of fpath until interrupted'
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address of the http server, default 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port of the http server, default 8080')
+    parser.add_argument('--socket', type=str, default='',
+                        help='path of a unix socket served instead of http')
+
+    config = parser.parse_args()
+    service: RuleService = RuleService(config)
+
+    if config.socket:
+        if os.path.exists(config.socket):
+            os.remove(config.socket)
+        server = socketserver.UnixStreamServer(config.socket, unix_handler(service))
+        print(f'serving on {config.socket}', file=sys.stderr)
+    else:
+        server = HTTPServer((config.host, config.port), http_handler(service))
+        print(f'serving on http://{config.host}:{config.port}', file=sys.stderr)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if config.socket and os.path.exists(config.socket):
+            os.remove(config.socket)